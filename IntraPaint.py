@@ -8,6 +8,7 @@ from PyQt5.QtWidgets import QInputDialog
 from PIL import Image
 import requests
 import io
+import json
 
 # argument parsing:
 parser = argparse.ArgumentParser()
@@ -23,6 +24,14 @@ parser.add_argument('--server_url', type = str, required = False, default = '',
                     help='Image generation server URL. If not provided, you will be prompted for a URL on launch.')
 parser.add_argument('--fast_ngrok_connection', type = str, required = False, default = '',
                     help='If true, connection rates will not be limited when using ngrok. This may cause rate limiting if you do not have a paid account.')
+parser.add_argument('--preview_format', type = str, required = False, default = 'WEBP',
+                    help='Image format used for intermediate samples (WEBP, JPEG or PNG). Final samples always use PNG.')
+parser.add_argument('--preview_quality', type = int, required = False, default = 80,
+                    help='Quality of intermediate samples when using a lossy preview format.')
+parser.add_argument('--fast_previews', dest='fast_previews', action='store_true',
+                    help='Show fast low-resolution approximations of intermediate samples instead of fully decoded images.')
+parser.add_argument('--poll_samples', dest='poll_samples', action='store_true',
+                    help='Poll the server for new samples instead of streaming them as they are created.')
 
 args = parser.parse_args()
 app = QApplication(sys.argv)
@@ -33,8 +42,9 @@ def inpaint(selection, mask, prompt, batchSize, batchCount, showSample, negative
     body = {
         'batch_size': batchSize,
         'num_batches': batchCount,
-        'edit': imageToBase64(selection),
-        'mask': imageToBase64(mask),
+        'previewFormat': args.preview_format,
+        'previewQuality': args.preview_quality,
+        'fastPreview': args.fast_previews,
         'prompt': prompt,
         'negative': negative,
         'guidanceScale': guidanceScale,
@@ -52,13 +62,63 @@ def inpaint(selection, mask, prompt, batchSize, batchCount, showSample, negative
                 print("RES")
                 print(serverResponse.content)
                 raise Exception(f"{serverResponse.status_code} response to {contextStr}: unknown error")
-    res = requests.post(args.server_url, json=body, timeout=30)
-    errorCheck(res, 'New inpainting request')
-        
     # POST to args.server_url, check response
     # If invalid or error response, throw Exception
+    # Images are sent as unencoded pixel data, avoiding both compression time and base64 inflation:
+    files = {
+        'params': (None, json.dumps(body), 'application/json'),
+        'edit': ('edit', imageToBytes(selection.convert('RGB'), 'RAW'), 'application/octet-stream'),
+        'mask': ('mask', imageToBytes(mask.convert('L'), 'RAW'), 'application/octet-stream')
+    }
+    res = requests.post(args.server_url, files=files, timeout=30)
+    errorCheck(res, 'New inpainting request')
+    jobUrl = f'{args.server_url}/jobs/{res.json()["uuid"]}'
+
     samples = {}
+    def loadSample(sampleName, sampleData):
+        sampleImage = loadImageFromBase64(sampleData['image'])
+        idx = int(sampleName) % batchSize
+        batch = int(sampleName) // batchSize
+        showSample(sampleImage, idx, batch)
+        samples[sampleName] = sampleData['timestamp']
+
+    def checkFinalStatus(jsonBody):
+        if not jsonBody['in_progress'] and jsonBody.get('status') == 'failed' and 'error' in jsonBody:
+            raise Exception(f"Inpainting failed: {jsonBody['error']}")
+
+    # Receive samples through server-sent events as soon as they're created. If the stream is unavailable or the
+    # connection drops, fall back to polling for any remaining samples.
     in_progress = True
+    if not args.poll_samples:
+        finalStatus = None
+        try:
+            res = requests.get(f'{jobUrl}/stream', stream=True, timeout=(30, 60))
+            errorCheck(res, 'sample stream request')
+            eventType = None
+            eventData = []
+            for line in res.iter_lines(decode_unicode=True):
+                if line.startswith('event:'):
+                    eventType = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    eventData.append(line[len('data:'):].strip())
+                elif line == '' and eventType is not None:
+                    jsonBody = json.loads('\n'.join(eventData))
+                    if eventType == 'sample':
+                        try:
+                            loadSample(jsonBody['name'], jsonBody)
+                        except Exception as err:
+                            print(f'Warning: {err}')
+                    elif eventType == 'status' and not jsonBody['in_progress']:
+                        finalStatus = jsonBody
+                    eventType = None
+                    eventData = []
+            res.close()
+        except Exception as err:
+            print(f'Sample stream failed, falling back to polling: {err}')
+        if finalStatus is not None:
+            checkFinalStatus(finalStatus)
+            in_progress = False
+
     errorCount = 0
     maxErrors = 10
     # refresh times in microseconds:
@@ -72,16 +132,20 @@ def inpaint(selection, mask, prompt, batchSize, batchCount, showSample, negative
         sleepTime = min(minRefresh * pow(2, errorCount), maxRefresh)
         print(f"Checking for response in {sleepTime//1000} ms...")
         QtCore.QThread.usleep(sleepTime)
-        # GET server_url/sample, sending previous samples:
+        # GET server_url/jobs/uuid/samples, sending previous samples:
         res = None
         try:
-            res = requests.get(f'{args.server_url}/sample', json={'samples': samples}, timeout=30)
+            res = requests.get(f'{jobUrl}/samples', json={'samples': samples}, timeout=30)
             errorCheck(res, 'sample update request')
         except Exception as err:
             errorCount += 1
             print(f'Error {errorCount}: {err}')
             if errorCount > maxErrors:
                 print('Inpainting failed, reached max retries.')
+                try:
+                    requests.delete(jobUrl, timeout=30)
+                except Exception as err:
+                    print(f'Failed to cancel inpainting request: {err}')
                 break
             else:
                 continue
@@ -94,16 +158,13 @@ def inpaint(selection, mask, prompt, batchSize, batchCount, showSample, negative
             continue
         for sampleName in jsonBody['samples'].keys():
             try:
-                sampleImage = loadImageFromBase64(jsonBody['samples'][sampleName]['image'])
-                idx = int(sampleName) % batchSize
-                batch = int(sampleName) // batchSize
-                showSample(sampleImage, idx, batch)
-                samples[sampleName] = jsonBody['samples'][sampleName]['timestamp']
+                loadSample(sampleName, jsonBody['samples'][sampleName])
             except Exception as err:
                 print(f'Warning: {err}')
                 errorCount += 1
                 continue
         in_progress = jsonBody['in_progress']
+        checkFinalStatus(jsonBody)
 
 window = MainWindow(size.width(), size.height(), None, inpaint)
 window.applyArgs(args)
@@ -6,6 +6,20 @@ from startup.utils import *
 parser = buildArgParser(includeGenParams=False, includeEditParams=False)
 parser.add_argument('--port', type = int, default = 5555, required = False,
                     help='Port used when running in server mode.')
+parser.add_argument('--max_queue_size', type = int, default = 8, required = False,
+                    help='Maximum number of queued inpainting requests, additional requests are rejected.')
+parser.add_argument('--max_batch_size', type = int, default = 4, required = False,
+                    help='Maximum number of images generated at once when merging queued requests.')
+parser.add_argument('--embedding_cache_size', type = int, default = 256, required = False,
+                    help='Number of prompt embeddings to keep cached in memory.')
+parser.add_argument('--embedding_cache_dir', type = str, default = None, required = False,
+                    help='Optional directory used to save prompt embeddings evicted from the memory cache.')
+parser.add_argument('--latent_cache_size', type = int, default = 32, required = False,
+                    help='Number of encoded edit images to keep cached in memory.')
+parser.add_argument('--result_ttl', type = int, default = 300, required = False,
+                    help='Seconds to keep finished results after they were last fetched.')
+parser.add_argument('--unfetched_result_ttl', type = int, default = 1800, required = False,
+                    help='Seconds to keep finished results that were never fetched.')
 args = parser.parse_args()
 
 import gc
@@ -35,7 +49,22 @@ model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normaliz
         clip_guidance = args.clip_guidance,
         cpu = args.cpu,
         ddpm = args.ddpm,
-        ddim = args.ddim)
+        ddim = args.ddim,
+        attention_backend = args.attention_backend,
+        compile_models = args.compile,
+        compile_cache_dir = args.compile_cache_dir)
 from colabFiles.server import startServer
-app = startServer(device, model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normalize)
+app = startServer(device, model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normalize,
+        max_queue_size=args.max_queue_size,
+        max_batch_size=args.max_batch_size,
+        result_ttl=args.result_ttl,
+        unfetched_result_ttl=args.unfetched_result_ttl,
+        embedding_cache_size=args.embedding_cache_size,
+        embedding_cache_dir=args.embedding_cache_dir,
+        latent_cache_size=args.latent_cache_size,
+        ddim=args.ddim,
+        dpm_solver=args.dpm_solver,
+        fast_plms_warmup=args.fast_plms_warmup,
+        convergence_tolerance=args.convergence_tolerance,
+        crop_margin=args.crop_margin)
 app.run(port=args.port, host= '0.0.0.0')
@@ -13,6 +13,8 @@ parser.add_argument('--edit_width', type = int, required = False, default = 256,
 
 parser.add_argument('--edit_height', type = int, required = False, default = 256,
                             help='height of the edit image in the generation frame (need to be multiple of 8)')
+parser.add_argument('--fast_previews', dest='fast_previews', action='store_true',
+                    help='Show fast low-resolution approximations of intermediate samples instead of fully decoded images.')
 parser.add_argument('--ui_test', dest='ui_test', action='store_true') # Test UI without loading real functionality
 args = parser.parse_args()
 
@@ -55,6 +57,7 @@ from startup.load_models import loadModels
 from startup.create_sample_function import createSampleFunction
 from startup.generate_samples import generateSamples
 from startup.ml_utils import *
+from startup.embedding_cache import EmbeddingCache, getModelHash
 
 device = torch.device('cuda:0' if (torch.cuda.is_available() and not args.cpu) else 'cpu')
 print('Using device:', device)
@@ -70,8 +73,13 @@ model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normaliz
         clip_guidance = args.clip_guidance,
         cpu = args.cpu,
         ddpm = args.ddpm,
-        ddim = args.ddim)
+        ddim = args.ddim,
+        attention_backend = args.attention_backend,
+        compile_models = args.compile,
+        compile_cache_dir = args.compile_cache_dir)
 print("Loaded models")
+embedding_cache = EmbeddingCache(getModelHash(bert, clip_model))
+latent_cache = EmbeddingCache(getModelHash(ldm), max_entries=32)
 
 app = QApplication(sys.argv)
 screen = app.primaryScreen()
@@ -117,15 +125,29 @@ def inpaint(selection, mask, prompt, batch_size, num_batches, showSample,
             clip_guidance=args.clip_guidance,
             skip_timesteps=skipSteps,
             ddpm=args.ddpm,
-            ddim=args.ddim)
+            ddim=args.ddim,
+            dpm_solver=args.dpm_solver,
+            fast_plms_warmup=args.fast_plms_warmup,
+            convergence_tolerance=args.convergence_tolerance,
+            crop_margin=args.crop_margin,
+            embedding_cache=embedding_cache,
+            latent_cache=latent_cache)
     def save_sample(i, sample, clip_score=False):
         foreachImageInSample(
                 sample,
                 batch_size,
                 ldm,
                 lambda k, img: showSample(img, k, i))
+    def preview_sample(i, sample, clip_score=False):
+        foreachImageInSample(
+                sample,
+                batch_size,
+                ldm,
+                lambda k, img: showSample(img, k, i),
+                preview=True)
 
-    generateSamples(device, ldm, diffusion, sample_fn, save_sample, batch_size, num_batches, selection.width, selection.height)
+    generateSamples(device, ldm, diffusion, sample_fn, save_sample, batch_size, num_batches, selection.width, selection.height,
+            preview_sample=preview_sample if args.fast_previews else None)
 
 d = MainWindow(size.width(), size.height(), None, inpaint)
 d.applyArgs(args)
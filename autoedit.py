@@ -282,15 +282,14 @@ elif model_params['image_condition']:
     image_embed = torch.zeros(args.batch_size*2, 4, args.height//8, args.width//8, device=device)
 
 # Create a classifier-free guidance sampling function
+# The sampler only tracks conditional entries, each model call runs them with both halves of kwargs.
 def model_fn(x_t, ts, **kwargs):
-    half = x_t[: len(x_t) // 2]
-    combined = torch.cat([half, half], dim=0)
-    model_out = model(combined, ts, **kwargs)
+    combined = torch.cat([x_t, x_t], dim=0)
+    model_out = model(combined, torch.cat([ts, ts], dim=0), **kwargs)
     eps, rest = model_out[:, :3], model_out[:, 3:]
     cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
     half_eps = uncond_eps + args.guidance_scale * (cond_eps - uncond_eps)
-    eps = torch.cat([half_eps, half_eps], dim=0)
-    return torch.cat([eps, rest], dim=1)
+    return torch.cat([half_eps, rest[:len(x_t)]], dim=1)
 
 
 def save_sample(i, sample, clip_score=False):
@@ -355,7 +354,9 @@ for i in range(args.iterations):
 
     samples = sample_fn(
         model_fn,
-        (args.batch_size*2, 4, int(args.height/8), int(args.width/8)),
+        (args.batch_size, 4, int(args.height/8), int(args.width/8)),
+        # Drawn at twice the batch size so a given seed produces the same noise as full-width guidance sampling:
+        noise=torch.randn(args.batch_size*2, 4, int(args.height/8), int(args.width/8), device=device)[:args.batch_size],
         clip_denoised=False,
         model_kwargs=kwargs,
         cond_fn=None,
@@ -0,0 +1,32 @@
+# Compares time and peak memory of each attention backend for self-attention over image-sized token sequences
+import torch
+from guided_diffusion.unet import ATTENTION_BACKENDS, CrossAttention
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare attention backend time and peak memory.')
+parser.add_argument('--sizes', type = int, nargs = '+', default = [256, 512], required = False,
+                    help='Square image sizes, each 8x8 pixel latent position is one token.')
+parser.add_argument('--batch_size', type = int, default = 2, required = False)
+parser.add_argument('--dim', type = int, default = 320, required = False,
+                    help='Attention width, 320 in the inpainting model\'s first transformer blocks.')
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+torch.manual_seed(0)
+module = CrossAttention(args.dim, heads=8, dim_head=args.dim // 8).eval().to(device)
+backends = [backend for backend in ATTENTION_BACKENDS
+        if backend != 'sdpa' or hasattr(torch.nn.functional, 'scaled_dot_product_attention')]
+
+rows = []
+for size in args.sizes:
+    tokens = (size // 8) ** 2
+    x = torch.randn(args.batch_size, tokens, args.dim, device=device)
+    for backend in backends:
+        module.attention_backend = backend
+        with torch.no_grad():
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            seconds = timeCall(lambda: module(x), device, args.repeat)
+            peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else 'n/a'
+        rows.append([size, tokens, backend, seconds * 1000, peak])
+printTable(['size', 'tokens', 'backend', 'ms', 'peak MiB'], rows)
@@ -0,0 +1,39 @@
+# Compares sampling throughput for several requests run one at a time, and merged into one model batch as the
+# server does with compatible queued jobs
+from guided_diffusion.script_util import create_gaussian_diffusion
+from startup.create_sample_function import createBatchedSampleFunction
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare images/sec for separate and merged request batches.')
+parser.add_argument('--requests', type = int, default = 4, required = False,
+                    help='Number of requests to sample.')
+parser.add_argument('--batch_size', type = int, default = 1, required = False,
+                    help='Images per request.')
+parser.add_argument('--steps', type = int, default = 10, required = False,
+                    help='Number of diffusion steps.')
+parser.add_argument('--width', type = int, default = 256, required = False)
+parser.add_argument('--height', type = int, default = 256, required = False)
+parser.add_argument('--model_channels', type = int, default = 64, required = False)
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+model = createBenchmarkUNet(device, args.model_channels)
+diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(args.steps))
+model.set_timestep_table(diffusion.reachable_timesteps())
+model.set_inference_mode(True)
+conditions = [(createBenchmarkConditioning(args.batch_size, device), args.batch_size, 5.0)
+        for _ in range(args.requests)]
+
+def sampleAll(groups):
+    for group in groups:
+        sample_fn = createBatchedSampleFunction(device, model, diffusion, group, width=args.width,
+                height=args.height)
+        for _ in sample_fn(None):
+            pass
+
+rows = []
+images = args.requests * args.batch_size
+for name, groups in (('separate', [[condition] for condition in conditions]), ('merged', [conditions])):
+    seconds = timeCall(lambda: sampleAll(groups), device, args.repeat)
+    rows.append([name, len(groups), seconds, images / seconds])
+printTable(['batching', 'model batches', 'seconds', 'images/sec'], rows)
@@ -0,0 +1,26 @@
+# Compares encoding time and size of sample images for each format the server can send
+import base64
+from PIL import Image
+from startup.utils import imageToBytes
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare sample image encoding time and size.')
+parser.add_argument('--image', type = str, default = 'examples/edit.png', required = False,
+                    help='Image to encode, resized to each benchmarked size.')
+parser.add_argument('--sizes', type = int, nargs = '+', default = [256, 512, 1024], required = False,
+                    help='Square image sizes to benchmark.')
+args = parser.parse_args()
+
+# (format, quality) pairs, PNG is always used for final samples:
+ENCODINGS = [('PNG', None), ('WEBP', 50), ('WEBP', 80), ('JPEG', 80), ('RAW', None)]
+
+source = Image.open(args.image).convert('RGB')
+rows = []
+for size in args.sizes:
+    image = source.resize((size, size), Image.LANCZOS)
+    for format, quality in ENCODINGS:
+        seconds = timeCall(lambda: imageToBytes(image, format, quality), repeat=args.repeat)
+        data = imageToBytes(image, format, quality)
+        rows.append([size, format if quality is None else f'{format} {quality}', seconds * 1000, len(data),
+                len(base64.b64encode(data))])
+printTable(['size', 'format', 'encode ms', 'bytes', 'base64 bytes'], rows)
@@ -0,0 +1,31 @@
+# Compares the cost of cheap latent-space previews with decoding intermediate samples through the VAE
+import os
+import torch
+from startup.ml_utils import foreachImageInSample
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare latent preview and VAE decode time for intermediate samples.')
+parser.add_argument('--kl_path', type = str, default = 'kl-f8.pt', required = False,
+                    help='Path to the LDM first stage model, the VAE decode is skipped if it does not exist.')
+parser.add_argument('--batch_size', type = int, default = 4, required = False)
+parser.add_argument('--width', type = int, default = 256, required = False)
+parser.add_argument('--height', type = int, default = 256, required = False)
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+sample = { 'pred_xstart': torch.randn(args.batch_size, 4, args.height // 8, args.width // 8, device=device) }
+ldm = None
+if os.path.exists(args.kl_path):
+    ldm = torch.load(args.kl_path, map_location='cpu').to(device).eval()
+else:
+    print(f'{args.kl_path} not found, only previews will be timed.')
+
+rows = []
+for name, preview in (('latent preview', True), ('VAE decode', False)):
+    if not preview and ldm is None:
+        continue
+    with torch.no_grad():
+        seconds = timeCall(lambda: foreachImageInSample(sample, args.batch_size, ldm, lambda k, image: None,
+                preview=preview), device, args.repeat)
+    rows.append([name, seconds * 1000, seconds * 1000 / args.batch_size])
+printTable(['method', 'batch ms', 'ms per image'], rows)
@@ -0,0 +1,39 @@
+# Compares QImage to PIL image conversion with the old PNG round-trip, across canvas sizes and image formats
+import io
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PIL import Image
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QBuffer
+from edit_ui.ui_utils import imageToQImage, qImageToImage
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare QImage to PIL image conversion methods.')
+parser.add_argument('--image', type = str, default = 'examples/edit.png', required = False,
+                    help='Image to convert, resized to each benchmarked size.')
+parser.add_argument('--sizes', type = int, nargs = '+', default = [256, 512, 1024, 2048], required = False,
+                    help='Square canvas sizes to benchmark.')
+args = parser.parse_args()
+
+def pngRoundTrip(qImage):
+    """The original qImageToImage implementation, with the lazily decoded image loaded."""
+    buffer = QBuffer()
+    buffer.open(QBuffer.ReadWrite)
+    qImage.save(buffer, "PNG")
+    pilImage = Image.open(io.BytesIO(buffer.data()))
+    pilImage.load()
+    return pilImage
+
+app = QApplication.instance() or QApplication([])
+source = Image.open(args.image).convert('RGB')
+rows = []
+for size in args.sizes:
+    rgbImage = imageToQImage(source.resize((size, size), Image.LANCZOS))
+    # The edited image and masks are ARGB32, inserted samples are RGB888:
+    for formatName, qImage in (('RGB888', rgbImage), ('ARGB32', rgbImage.convertToFormat(QImage.Format_ARGB32))):
+        pngSeconds = timeCall(lambda: pngRoundTrip(qImage), repeat=args.repeat)
+        directSeconds = timeCall(lambda: qImageToImage(qImage).load(), repeat=args.repeat)
+        rows.append([size, formatName, pngSeconds * 1000, directSeconds * 1000, pngSeconds / directSeconds])
+printTable(['size', 'format', 'PNG ms', 'direct ms', 'speedup'], rows)
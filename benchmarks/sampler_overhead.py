@@ -0,0 +1,43 @@
+# Measures the per-step overhead of the diffusion samplers themselves, using a stand-in model that does almost no work
+import torch
+from guided_diffusion.script_util import create_gaussian_diffusion
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Measure sampler overhead per diffusion step.')
+parser.add_argument('--steps', type = int, default = 50, required = False,
+                    help='Number of diffusion steps.')
+parser.add_argument('--batch_size', type = int, default = 4, required = False)
+parser.add_argument('--width', type = int, default = 256, required = False)
+parser.add_argument('--height', type = int, default = 256, required = False)
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(args.steps))
+shape = (args.batch_size, 4, args.height // 8, args.width // 8)
+noise = torch.randn(*shape, device=device)
+
+def stubModel(x, ts, **kwargs):
+    return x * 0.1
+
+def uncachedStubModel(x, ts, **kwargs):
+    # Schedule tensors are copied to the device again on the next lookup, as they were before they were cached:
+    diffusion._schedule_tensors.clear()
+    diffusion._map_tensors.clear()
+    return stubModel(x, ts, **kwargs)
+
+def sample(method, model, **kwargs):
+    for _ in getattr(diffusion, method)(model, shape, noise=noise, clip_denoised=False, device=device, **kwargs):
+        pass
+
+SAMPLERS = [
+    ('PLMS', 'plms_sample_loop_progressive', {}),
+    ('PLMS, lower-order warm-up', 'plms_sample_loop_progressive', { 'prk_warmup': False }),
+    ('DDIM', 'ddim_sample_loop_progressive', {}),
+    ('DPM-Solver++', 'dpm_solver_sample_loop_progressive', {})
+]
+rows = []
+for name, method, kwargs in SAMPLERS:
+    for cacheName, model in (('cached', stubModel), ('cleared every step', uncachedStubModel)):
+        seconds = timeCall(lambda: sample(method, model, **kwargs), device, args.repeat)
+        rows.append([name, cacheName, seconds * 1000 / args.steps])
+printTable(['sampler', 'schedule tensors', 'ms per step'], rows)
@@ -0,0 +1,72 @@
+# Compares sampler accuracy and cost at several step counts. Accuracy is measured with a stand-in model that
+# denoises Gaussian data exactly, so the sample every deterministic sampler converges to is known. Cost is measured as
+# model evaluations, and as time with a randomly initialized UNet.
+import torch
+from guided_diffusion.script_util import create_gaussian_diffusion
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare sampler accuracy and cost.')
+parser.add_argument('--steps', type = int, nargs = '+', default = [10, 15, 25, 50, 100], required = False,
+                    help='Step counts to compare.')
+parser.add_argument('--reference_steps', type = int, default = 250, required = False,
+                    help='DDIM step count used as the reference quality.')
+parser.add_argument('--model_channels', type = int, default = 64, required = False,
+                    help='UNet width used for timing, or 0 to skip timing.')
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+DATA_STD = 0.5
+SHAPE = (2, 4, 32, 32)
+ALPHAS_CUMPROD = torch.from_numpy(create_gaussian_diffusion(steps=1000).alphas_cumprod).to(device)
+noise = torch.randn(*SHAPE, device=device, generator=torch.Generator(device).manual_seed(0))
+
+def gaussianDataModel(x, ts, **kwargs):
+    """Returns the exact eps prediction for data drawn from N(0, DATA_STD^2)."""
+    ts = ts.double()
+    alpha_bar = torch.lerp(ALPHAS_CUMPROD[ts.floor().long()], ALPHAS_CUMPROD[ts.ceil().long()], ts.frac())
+    alpha_bar = alpha_bar.view(-1, 1, 1, 1)
+    return (torch.sqrt(1 - alpha_bar) * x.double() / (alpha_bar * DATA_STD ** 2 + 1 - alpha_bar)).to(x.dtype)
+
+# The probability flow ODE maps the initial noise to this sample, for Gaussian data it just rescales the noise:
+exact = (noise.double() * DATA_STD / torch.sqrt(ALPHAS_CUMPROD[-1] * DATA_STD ** 2 + 1 - ALPHAS_CUMPROD[-1])).float()
+
+def sample(method, steps, model, **kwargs):
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(steps))
+    for out in getattr(diffusion, method)(model, SHAPE, noise=noise, clip_denoised=False, device=device, **kwargs):
+        pass
+    return out['pred_xstart']
+
+def countedSample(method, steps, **kwargs):
+    """Returns the maximum error of a sample, and the number of model evaluations it took."""
+    calls = []
+    def countingModel(x, ts, **kwargs):
+        calls.append(ts)
+        return gaussianDataModel(x, ts, **kwargs)
+    result = sample(method, steps, countingModel, **kwargs)
+    return (result - exact).abs().max().item(), len(calls)
+
+if args.model_channels > 0:
+    unet = createBenchmarkUNet(device, args.model_channels)
+    model_kwargs = createBenchmarkConditioning(SHAPE[0] // 2, device)
+    def unetModel(x, ts, **kwargs):
+        return unet(x, ts, **model_kwargs)
+
+SAMPLERS = [
+    ('PLMS', 'plms_sample_loop_progressive', {}),
+    ('PLMS, lower-order warm-up', 'plms_sample_loop_progressive', { 'prk_warmup': False }),
+    ('DDIM', 'ddim_sample_loop_progressive', {}),
+    ('DPM-Solver++', 'dpm_solver_sample_loop_progressive', {})
+]
+referenceError, _ = countedSample('ddim_sample_loop_progressive', args.reference_steps)
+print(f'DDIM reference with {args.reference_steps} steps: max error {referenceError:.4g}')
+rows = []
+for steps in args.steps:
+    for name, method, kwargs in SAMPLERS:
+        error, calls = countedSample(method, steps, **kwargs)
+        row = [name, steps, calls, error, error / referenceError]
+        if args.model_channels > 0:
+            with torch.no_grad():
+                row.append(timeCall(lambda: sample(method, steps, unetModel, **kwargs), device, args.repeat, 0))
+        rows.append(row)
+headers = ['sampler', 'steps', 'model calls', 'max error', 'vs reference']
+printTable(headers + (['UNet seconds'] if args.model_channels > 0 else []), rows)
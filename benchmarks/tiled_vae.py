@@ -0,0 +1,48 @@
+# Compares VAE decode time and peak memory with and without tiling, across image sizes
+import os
+import torch
+from startup.tiled_vae import TiledVAE
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare tiled and untiled VAE decoding.')
+parser.add_argument('--kl_path', type = str, default = 'kl-f8.pt', required = False,
+                    help='Path to the LDM first stage model, a small stand-in decoder is used if it does not exist.')
+parser.add_argument('--sizes', type = int, nargs = '+', default = [512, 1024], required = False,
+                    help='Square image sizes to decode.')
+args = parser.parse_args()
+
+class StandInDecoder(torch.nn.Module):
+    """Upsamples latents 8x through convolutions, roughly following the kl-f8 decoder's shape but much narrower."""
+
+    def __init__(self, channels=64):
+        super().__init__()
+        layers = [torch.nn.Conv2d(4, channels, 3, padding=1)]
+        for _ in range(3):
+            layers += [torch.nn.Upsample(scale_factor=2), torch.nn.Conv2d(channels, channels, 3, padding=1),
+                    torch.nn.SiLU()]
+        layers.append(torch.nn.Conv2d(channels, 3, 3, padding=1))
+        self.layers = torch.nn.Sequential(*layers)
+
+    def decode(self, latents):
+        return self.layers(latents)
+
+device = getBenchmarkDevice(args.cpu)
+if os.path.exists(args.kl_path):
+    decoder = torch.load(args.kl_path, map_location='cpu')
+else:
+    print(f'{args.kl_path} not found, using a stand-in decoder.')
+    decoder = StandInDecoder()
+decoder = decoder.to(device).eval()
+
+rows = []
+for size in args.sizes:
+    latents = torch.randn(1, 4, size // 8, size // 8, device=device)
+    for name, threshold in (('untiled', None), ('tiled', 0)):
+        vae = TiledVAE(decoder, tile_threshold=threshold)
+        with torch.no_grad():
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            seconds = timeCall(lambda: vae.decode(latents), device, args.repeat)
+            peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else 'n/a'
+        rows.append([size, name, seconds * 1000, peak])
+printTable(['size', 'decode', 'ms', 'peak MiB'], rows)
@@ -0,0 +1,70 @@
+# Compares UNet time per sampling step with each inference optimization enabled
+import time
+import torch
+from guided_diffusion.script_util import create_gaussian_diffusion
+from startup.compiled_models import SizeBucketedCompile
+from benchmarks.utils import *
+
+parser = buildBenchmarkArgParser('Compare UNet time per sampling step across inference options.')
+parser.add_argument('--steps', type = int, default = 10, required = False,
+                    help='Number of model calls timed per run, each with a new timestep.')
+parser.add_argument('--batch_size', type = int, default = 2, required = False,
+                    help='Model batch size, including unconditional entries.')
+parser.add_argument('--width', type = int, default = 256, required = False)
+parser.add_argument('--height', type = int, default = 256, required = False)
+parser.add_argument('--model_channels', type = int, default = 64, required = False)
+parser.add_argument('--compile_backend', type = str, default = 'inductor', required = False,
+                    help='torch.compile backend for the compiled configuration, or "none" to skip it.')
+args = parser.parse_args()
+
+device = getBenchmarkDevice(args.cpu)
+model = createBenchmarkUNet(device, args.model_channels)
+diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(args.steps))
+timesteps = torch.tensor(diffusion.timestep_map, device=device, dtype=torch.float32)
+x = torch.randn(args.batch_size, 4, args.height // 8, args.width // 8, device=device)
+# Sampling passes the same conditioning tensors to every step:
+model_kwargs = createBenchmarkConditioning(args.batch_size // 2, device)
+
+def runSteps():
+    with torch.no_grad():
+        for t in timesteps:
+            model(x, t.expand(args.batch_size), **model_kwargs)
+
+def checkpointWrappers():
+    model.set_inference_mode(False)
+
+def inferenceMode():
+    model.set_inference_mode(True, cache_context=False)
+
+def conditioningCaches():
+    model.set_inference_mode(True)
+
+def timestepTable():
+    model.set_timestep_table(diffusion.reachable_timesteps())
+    model.set_inference_mode(True)
+
+def compiledBlocks():
+    # Set up the same way as loadModels(compile_models=True):
+    model.set_inference_mode(True, cache_context=False)
+    model.apply_blocks = SizeBucketedCompile(model.apply_blocks, [(args.width, args.height)], scale=8,
+            backend=args.compile_backend)
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    start = time.perf_counter()
+    runSteps()
+    synchronize()
+    print(f'Compiling and running the first {args.steps} steps took {time.perf_counter() - start:.1f}s')
+
+CONFIGURATIONS = [
+    ('checkpoint wrappers', checkpointWrappers),
+    ('inference mode', inferenceMode),
+    ('+ conditioning caches', conditioningCaches),
+    ('+ timestep table', timestepTable)
+]
+if args.compile_backend != 'none':
+    CONFIGURATIONS.append(('+ compiled blocks', compiledBlocks))
+rows = []
+for name, setup in CONFIGURATIONS:
+    setup()
+    seconds = timeCall(runSteps, device, args.repeat)
+    rows.append([name, seconds * 1000 / args.steps])
+printTable(['configuration', 'ms per step'], rows)
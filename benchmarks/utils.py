@@ -0,0 +1,75 @@
+# Shared helpers for benchmark scripts, which run from the repository root, e.g. `python -m benchmarks.batching`
+import argparse
+import time
+import torch
+
+def buildBenchmarkArgParser(description):
+    """Create a command-line argument parser that includes options shared between benchmark scripts."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--cpu', dest='cpu', action='store_true',
+                        help='Run on the CPU even if CUDA is available.')
+    parser.add_argument('--repeat', type = int, default = 5, required = False,
+                        help='Number of timed runs, the fastest is reported.')
+    return parser
+
+def getBenchmarkDevice(useCPU=False):
+    """Returns the CUDA device if available, or the CPU."""
+    if useCPU or not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device('cuda:0')
+
+def timeCall(fn, device=None, repeat=5, warmup=1):
+    """
+    Returns the fastest time in seconds out of repeat calls to fn, after warmup untimed calls. If device is a CUDA
+    device, queued device work is included in each time.
+    """
+    def synchronize():
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        synchronize()
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def createBenchmarkUNet(device, model_channels=64, context_dim=128, clip_embed_dim=128, use_checkpoint=False):
+    """
+    Creates a randomly initialized UNetModel with the same block layout as the inpainting model, but fewer channels
+    by default so that benchmarks also finish on the CPU. Use --model_channels 320 for the inpainting model's width.
+    """
+    from guided_diffusion.unet import UNetModel
+    torch.manual_seed(0)
+    model = UNetModel(
+            image_size=32,
+            in_channels=4,
+            model_channels=model_channels,
+            out_channels=4,
+            num_res_blocks=2,
+            attention_resolutions=(2, 4),
+            channel_mult=(1, 2, 4),
+            num_heads=8,
+            use_checkpoint=use_checkpoint,
+            context_dim=context_dim,
+            clip_embed_dim=clip_embed_dim)
+    return model.eval().requires_grad_(False).to(device)
+
+def createBenchmarkConditioning(batch_size, device, context_dim=128, clip_embed_dim=128):
+    """Creates random model_kwargs for createBenchmarkUNet models, with conditional and unconditional entries."""
+    return {
+        "context": torch.randn(batch_size * 2, 77, context_dim, device=device),
+        "clip_embed": torch.randn(batch_size * 2, clip_embed_dim, device=device),
+        "image_embed": None
+    }
+
+def printTable(headers, rows):
+    """Prints rows of values as a table with aligned columns."""
+    rows = [[f'{value:.4g}' if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max(len(str(header)), *(len(row[i]) for row in rows)) for i, header in enumerate(headers)]
+    print('  '.join(str(header).rjust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
@@ -1,25 +1,95 @@
-from flask import Flask, request, jsonify, make_response, abort, current_app, send_file
+from flask import Flask, Response, request, jsonify, make_response, abort, current_app, send_file, stream_with_context
 from flask_cors import CORS, cross_origin
 from PIL import Image
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
+from collections import deque
 import torch
 from torchvision.transforms import functional as TF
 import numpy as np
 from startup.utils import *
 from startup.ml_utils import *
 from startup.load_models import loadModels
-from startup.create_sample_function import createSampleFunction
-from startup.generate_samples import generateSamples
+from startup.create_sample_function import createConditioning, createBatchedSampleFunction
+from startup.generate_samples import generateBatchedSamples
+from startup.embedding_cache import EmbeddingCache, getModelHash
 import io
 import base64
+import uuid
+import json
 from datetime import datetime
 
-def startServer(device, model_params, model, diffusion, ldm_model, bert_model, clip_model, clip_preprocess, normalize):
+class InpaintingJob():
+    """Holds the parameters, state, and generated samples for a single queued inpainting request."""
+
+    def __init__(self, params):
+        self.id = str(uuid.uuid4())
+        self.params = params
+        self.status = 'queued'
+        self.samples = {}
+        self.error = None
+        self.cancelled = False
+        self.finish_time = None
+        self.last_fetch_time = None
+        self.steps_used = []
+
+    def is_done(self):
+        return self.status in ('finished', 'cancelled', 'failed')
+
+    def is_expired(self, now, result_ttl, unfetched_result_ttl):
+        """
+        Checks if a finished job's results should be discarded. Results that were fetched at least once after the job
+        finished expire after result_ttl seconds, results that were never fetched are kept for unfetched_result_ttl.
+        """
+        if not self.is_done():
+            return False
+        if self.last_fetch_time is not None and self.last_fetch_time >= self.finish_time:
+            return (now - self.last_fetch_time) > result_ttl
+        return (now - self.finish_time) > unfetched_result_ttl
+
+
+def startServer(device, model_params, model, diffusion, ldm_model, bert_model, clip_model, clip_preprocess, normalize,
+        max_queue_size=8,
+        max_batch_size=4,
+        result_ttl=300,
+        unfetched_result_ttl=1800,
+        stream_keepalive=15,
+        embedding_cache_size=256,
+        embedding_cache_dir=None,
+        latent_cache_size=32,
+        ddim=False,
+        dpm_solver=False,
+        fast_plms_warmup=False,
+        convergence_tolerance=0,
+        crop_margin=None):
     """
-    Starts a Flask server to handle inpainting requests from a remote UI.
+    Starts a Flask server to handle inpainting requests from remote UI clients.
 
-    Note that this server can only handle a single client. In the future, using a direct connection would probably
-    be superior, but it's not worth the extra effort right now.
+    Each inpainting request is assigned a UUID and added to a queue, requests are rejected once the queue holds
+    max_queue_size jobs. A single worker thread runs queued jobs in order, merging queued jobs with matching
+    dimensions and skipSteps values into shared model batches of up to max_batch_size images. Clients fetch results
+    for their own job using its UUID, and may cancel queued or running jobs. Results of finished jobs are discarded
+    result_ttl seconds after they were last fetched, or unfetched_result_ttl seconds after finishing if they were
+    never fetched.
+
+    Inpainting requests may upload images as binary multipart files instead of base64 JSON fields, and may request
+    lossy WEBP or JPEG encoding for intermediate samples with previewFormat and previewQuality. Final samples are
+    always PNG. Setting fastPreview creates intermediate samples with a cheap low-resolution approximation instead of
+    the full VAE decoder. Individual samples can also be fetched as binary files from GET /jobs/<id>/samples/<name>.
+
+    Instead of polling for samples, clients may open GET /jobs/<id>/stream to receive each sample image and status
+    change as a server-sent event, as soon as it is available. Idle streams send a keep-alive comment every
+    stream_keepalive seconds.
+
+    Prompt embeddings are cached, keeping embedding_cache_size prompts in memory and saving evicted prompts to
+    embedding_cache_dir if provided. VAE latents of the latent_cache_size most recent edit images are also cached,
+    so repeated requests on the same image section skip the VAE encoder. Cache hit and miss counts are available
+    from GET /stats.
+
+    Samples are generated with PLMS, or with DDIM or DPM-Solver++ if ddim or dpm_solver is set. fast_plms_warmup
+    replaces the PRK steps that start PLMS sampling with cheaper lower-order multistep steps. If
+    convergence_tolerance is greater than zero, sampling stops once the inpainted area stops changing, and job status
+    responses list the number of steps used for each batch. If crop_margin is set, only the masked area and crop_margin
+    pixels of context around it are generated.
     """
 
 
@@ -30,12 +100,196 @@ def startServer(device, model_params, model, diffusion, ldm_model, bert_model, c
     context.push()
 
     with context:
-        current_app.lastRequest = None
-        current_app.lastError = None
-        current_app.in_progress = False
-        current_app.thread = None
-        current_app.samples = {}
+        current_app.jobs = {}
+        current_app.queue = deque()
         current_app.lock = Lock()
+        current_app.job_available = Condition(current_app.lock)
+        current_app.job_updated = Condition(current_app.lock)
+        current_app.thread = None
+
+    embedding_cache = EmbeddingCache(getModelHash(bert_model, clip_model), embedding_cache_size, embedding_cache_dir)
+    latent_cache = EmbeddingCache(getModelHash(ldm_model), latent_cache_size)
+
+    def removeExpiredJobs():
+        """Discards expired job results. This must only be called while holding current_app.lock."""
+        now = datetime.timestamp(datetime.now())
+        expired = [jobId for jobId, job in current_app.jobs.items()
+                if job.is_expired(now, result_ttl, unfetched_result_ttl)]
+        for jobId in expired:
+            del current_app.jobs[jobId]
+
+    def getJobOr404(jobId):
+        """Returns the job with the given id. This must only be called while holding current_app.lock."""
+        removeExpiredJobs()
+        if jobId not in current_app.jobs:
+            abort(make_response({"error": f"No inpainting job with id {jobId} found"}, 404))
+        return current_app.jobs[jobId]
+
+    def getJobStatus(job):
+        """Returns a job's current status fields. This must only be called while holding current_app.lock."""
+        status = { "status": job.status, "in_progress": not job.is_done() }
+        if job.error is not None:
+            status["error"] = job.error
+        if len(job.steps_used) > 0:
+            status["steps_used"] = list(job.steps_used)
+        if job.status == 'queued':
+            status["queue_position"] = current_app.queue.index(job) + 1
+        return status
+
+    def sampleToJson(sample):
+        """Converts a stored sample to a JSON-compatible dict, with base64-encoded image data."""
+        return { **sample, "image": str(base64.b64encode(sample["image"]), 'utf-8') }
+
+    def isCancelled(job):
+        with current_app.lock:
+            return job.cancelled
+
+    def setJobError(job, error):
+        with current_app.lock:
+            job.error = error
+            print(job.error)
+            current_app.job_updated.notify_all()
+
+    def isCompatible(job, other):
+        """Checks if two jobs can be merged into a single model batch."""
+        return all(job.params[key] == other.params[key] for key in ('width', 'height', 'skip_timesteps'))
+
+    def takeJobGroup():
+        """
+        Removes the next job from the queue, along with any queued jobs that can share its model batches without
+        exceeding max_batch_size. This must only be called while holding current_app.lock.
+        """
+        job = current_app.queue.popleft()
+        group = [job]
+        total_size = job.params['batch_size']
+        for other in list(current_app.queue):
+            if isCompatible(job, other) and total_size + other.params['batch_size'] <= max_batch_size:
+                current_app.queue.remove(other)
+                group.append(other)
+                total_size += other.params['batch_size']
+        for job in group:
+            job.status = 'running'
+        current_app.job_updated.notify_all()
+        return group
+
+    def runJobs(jobs):
+        """Generates all samples for a group of compatible jobs, storing them within each job as they're created."""
+        conditions = {}
+        for job in jobs:
+            params = job.params
+            try:
+                model_kwargs, _ = createConditioning(
+                        device,
+                        model_params,
+                        bert_model,
+                        clip_model,
+                        ldm_model,
+                        edit=params['edit'],
+                        mask=params['mask'],
+                        prompt=params['prompt'],
+                        negative=params['negative'],
+                        batch_size=params['batch_size'],
+                        width=params['width'],
+                        height=params['height'],
+                        embedding_cache=embedding_cache,
+                        latent_cache=latent_cache)
+                conditions[job.id] = (model_kwargs, params['batch_size'], params['guidance_scale'])
+            except Exception as err:
+                setJobError(job, f"creating sample function failed, {err}")
+        jobs = [job for job in jobs if job.id in conditions]
+        if len(jobs) == 0:
+            return
+        width = jobs[0].params['width']
+        height = jobs[0].params['height']
+
+        def getSaveFn(job):
+            batch_size = job.params['batch_size']
+            def save_sample(i, sample, final=False):
+                if isCancelled(job):
+                    return
+                timestamp = datetime.timestamp(datetime.now())
+                # Intermediate samples are replaced within a few steps, so only final samples need lossless encoding:
+                format = 'PNG' if final else job.params['preview_format']
+                try:
+                    def addImageToResponse(k, image):
+                        name = f'{i * batch_size + k:05}'
+                        image = imageToBytes(image, format, job.params['preview_quality'])
+                        with current_app.lock:
+                            # The job may have been cancelled while the image was being encoded:
+                            if job.cancelled:
+                                return
+                            job.samples[name] = { "image": image, "format": format, "timestamp": timestamp }
+                            current_app.job_updated.notify_all()
+                    foreachImageInSample(sample, batch_size, ldm_model, addImageToResponse,
+                            preview=(not final and job.params['fast_preview']))
+                except Exception as err:
+                    setJobError(job, f"sample save error: {err}")
+            return save_sample
+
+        # Jobs requesting more batches keep running after others in the group finish:
+        i = 0
+        while True:
+            batchJobs = [job for job in jobs if job.params['num_batches'] > i and not isCancelled(job)]
+            if len(batchJobs) == 0:
+                break
+            sample_fn = createBatchedSampleFunction(
+                    device,
+                    model,
+                    diffusion,
+                    [conditions[job.id] for job in batchJobs],
+                    width=width,
+                    height=height,
+                    skip_timesteps=batchJobs[0].params['skip_timesteps'],
+                    ddim=ddim,
+                    dpm_solver=dpm_solver,
+                    fast_plms_warmup=fast_plms_warmup,
+                    convergence_tolerance=convergence_tolerance,
+                    crop_margin=crop_margin)
+            # Samplers can't drop rows from a batch in progress, so a batch only ends early once all of its jobs are
+            # cancelled:
+            steps = generateBatchedSamples(
+                    diffusion,
+                    sample_fn,
+                    [getSaveFn(job) for job in batchJobs],
+                    [job.params['batch_size'] for job in batchJobs],
+                    batch_index=i,
+                    should_stop=lambda: all(isCancelled(job) for job in batchJobs))
+            if steps is not None:
+                with current_app.lock:
+                    for job in batchJobs:
+                        job.steps_used.append(steps)
+            i += 1
+
+    def run_thread():
+        with context:
+            while True:
+                with current_app.lock:
+                    while len(current_app.queue) == 0:
+                        current_app.job_available.wait(timeout=60)
+                        removeExpiredJobs()
+                    jobs = takeJobGroup()
+                try:
+                    runJobs(jobs)
+                except Exception as err:
+                    for job in jobs:
+                        setJobError(job, f"inpainting failed, {err}")
+                with current_app.lock:
+                    for job in jobs:
+                        if job.cancelled:
+                            # Already marked cancelled with a finish time when the cancel request arrived:
+                            job.params = None
+                            continue
+                        if job.error is not None:
+                            job.status = 'failed'
+                        else:
+                            job.status = 'finished'
+                        job.finish_time = datetime.timestamp(datetime.now())
+                        job.params = None
+                    current_app.job_updated.notify_all()
+
+    with context:
+        current_app.thread = Thread(target = run_thread, daemon=True)
+        current_app.thread.start()
 
     # Check if the server's up:
     @app.route("/", methods=["GET"])
@@ -43,115 +297,177 @@ def startServer(device, model_params, model, diffusion, ldm_model, bert_model, c
     def health_check():
         return jsonify(success=True)
 
-    # Start an inpainting request:
+    # Get server statistics:
+    @app.route("/stats", methods=["GET"])
+    @cross_origin()
+    def get_stats():
+        with current_app.lock:
+            queued = len(current_app.queue)
+        return jsonify(queued=queued, embedding_cache=embedding_cache.stats(), latent_cache=latent_cache.stats())
+
+    # Queue an inpainting request:
     @app.route("/", methods=["POST"])
     @cross_origin()
     def startInpainting():
-        # Extract arguments from body, convert images from base64
-        json = request.get_json(force=True)
+        # Extract arguments from body. Requests either hold JSON with base64-encoded images, or multipart form data
+        # with JSON parameters in the 'params' field and binary 'edit' and 'mask' files. Files sent as
+        # application/octet-stream hold raw RGB (edit) or 8-bit grayscale (mask) pixels at the requested size, other
+        # files are decoded as image files.
+        multipart = request.mimetype == 'multipart/form-data'
+        try:
+            body = json.loads(request.form['params']) if multipart else request.get_json(force=True)
+        except Exception as err:
+            abort(make_response({"error": f"loading request parameters failed, {err}"}, 400))
         def requestedOrDefault(key, defaultValue):
-            if key in json:
-                return json[key]
+            if key in body:
+                return body[key]
             return defaultValue
-        batch_size = requestedOrDefault('batch_size', 1)
-        num_batches = requestedOrDefault('num_batches', 1)
         width = requestedOrDefault('width', 256)
         height = requestedOrDefault('height', 256)
 
+        def loadRequestImage(key, rawMode):
+            if not multipart:
+                return loadImageFromBase64(body[key])
+            file = request.files[key]
+            if file.mimetype == 'application/octet-stream':
+                return loadImageFromBytes(file.read(), rawMode, (width, height))
+            return loadImageFromBytes(file.read())
+
+        preview_format = str(requestedOrDefault("previewFormat", "PNG")).upper()
+        if preview_format not in ('PNG', 'WEBP', 'JPEG'):
+            abort(make_response({"error": f"unsupported preview format {preview_format}"}, 400))
+
         edit = None
         mask = None
         try:
-            edit = loadImageFromBase64(json["edit"])
+            edit = loadRequestImage("edit", 'RGB')
         except Exception as err:
             print(f"loading edit image failed, {err}")
             abort(make_response({"error": f"loading edit image failed, {err}"}, 400))
         try:
-            mask = loadImageFromBase64(json["mask"])
+            mask = loadRequestImage("mask", 'L')
         except Exception as err:
             print(f"loading mask image failed, {err}")
             abort(make_response({"error": f"loading mask image failed, {err}"}, 400))
 
-        sample_fn = None
-        try:
-            sample_fn, clip_score_fn = createSampleFunction(
-                    device,
-                    model,
-                    model_params,
-                    bert_model,
-                    clip_model,
-                    clip_preprocess,
-                    ldm_model,
-                    diffusion,
-                    normalize,
-                    edit=edit,
-                    mask=mask,
-                    prompt = requestedOrDefault("prompt", ""),
-                    negative = requestedOrDefault("negative", ""),
-                    guidance_scale = requestedOrDefault("guidanceScale", 5.0),
-                    batch_size = batch_size,
-                    width = width,
-                    height = height,
-                    cutn = requestedOrDefault("cutn", 16),
-                    skip_timesteps = requestedOrDefault("skipSteps", False))
-        except Exception as err:
-            abort(make_response({"error": f"creating sample function failed, {err}"}, 500))
-
-        def save_sample(i, sample, clip_score=False):
-            with current_app.lock:
-                timestamp = datetime.timestamp(datetime.now())
-                try:
-                    def addImageToResponse(k, image):
-                        name = f'{i * batch_size + k:05}'
-                        current_app.samples[name] = { "image": imageToBase64(image), "timestamp": timestamp }
-                    foreachImageInSample(sample, batch_size, ldm_model, addImageToResponse)
-                except Exception as err:
-                    current_app.lastError = f"sample save error: {err}"
-                    print(current_app.lastError)
+        job = InpaintingJob({
+            'edit': edit,
+            'mask': mask,
+            'prompt': requestedOrDefault("prompt", ""),
+            'negative': requestedOrDefault("negative", ""),
+            'guidance_scale': requestedOrDefault("guidanceScale", 5.0),
+            'batch_size': requestedOrDefault('batch_size', 1),
+            'num_batches': requestedOrDefault('num_batches', 1),
+            'width': width,
+            'height': height,
+            'cutn': requestedOrDefault("cutn", 16),
+            'skip_timesteps': requestedOrDefault("skipSteps", False),
+            'preview_format': preview_format,
+            'preview_quality': requestedOrDefault("previewQuality", 80),
+            'fast_preview': requestedOrDefault("fastPreview", False)
+        })
 
-        def run_thread():
-            with context:
-                generateSamples(device,
-                        ldm_model,
-                        diffusion,
-                        sample_fn,
-                        save_sample,
-                        batch_size,
-                        num_batches,
-                        width,
-                        height)
-                with current_app.lock:
-                    current_app.in_progress = False
-                
-        # Start image generation thread:
         with current_app.lock:
-            if current_app.in_progress or current_app.thread and current_app.thread.is_alive():
-                abort(make_response({error: "Cannot start a new operation, an existing operation is still running"}, 409))
-            current_app.samples = {}
-            current_app.in_progress = True
-            current_app.thread = Thread(target = run_thread)
-            current_app.thread.start()
+            removeExpiredJobs()
+            if len(current_app.queue) >= max_queue_size:
+                abort(make_response({"error": f"Cannot queue a new operation, {max_queue_size} operations are already waiting"}, 429))
+            current_app.jobs[job.id] = job
+            current_app.queue.append(job)
+            queue_position = len(current_app.queue)
+            current_app.job_available.notify()
+            current_app.job_updated.notify_all()
 
-        return jsonify(success=True)
+        return jsonify(success=True, uuid=job.id, queue_position=queue_position)
 
-    # Request updated images:
-    @app.route("/sample", methods=["GET"])
+    # Request updated images for a specific job:
+    @app.route("/jobs/<jobId>/samples", methods=["GET"])
     @cross_origin()
-    def list_updated():
-        json = request.get_json(force=True)
-        # Parse (sampleName, timestamp) pairs from request.samples
-        # Check (sampleName, timestamp) pairs from the most recent request. If any missing from the request or have a
-        # newer timestamp, set response.samples[sampleName] = { timestamp, base64Image }
+    def list_updated(jobId):
+        body = request.get_json(force=True, silent=True) or {}
+        knownSamples = body["samples"] if "samples" in body else {}
+        # Check (sampleName, timestamp) pairs from the request. If any are missing from the request or have a newer
+        # timestamp, set response.samples[sampleName] = { timestamp, base64Image }
         response = { "samples": {} }
         with current_app.lock:
-            for key in current_app.samples:
-                if key not in json["samples"] or json["samples"][key] < current_app.samples[key]["timestamp"]:
-                    response["samples"][key] = current_app.samples[key]
-            # If any errors were saved for the most recent request, use those to set response.errors
-            if current_app.lastError != "":
-                response["error"] = current_app.lastError
-
-            # Check if the most recent request is finished, use this to set response.in_progress.
-            response["in_progress"] = current_app.in_progress
+            job = getJobOr404(jobId)
+            for key in job.samples:
+                if key not in knownSamples or knownSamples[key] < job.samples[key]["timestamp"]:
+                    response["samples"][key] = sampleToJson(job.samples[key])
+            response.update(getJobStatus(job))
+            job.last_fetch_time = datetime.timestamp(datetime.now())
         return response
 
+    # Stream status changes and sample images for a specific job as server-sent events:
+    @app.route("/jobs/<jobId>/stream", methods=["GET"])
+    @cross_origin()
+    def stream_updates(jobId):
+        lock = current_app.lock
+        job_updated = current_app.job_updated
+        with lock:
+            job = getJobOr404(jobId)
+
+        def serverSentEvent(eventType, data):
+            return f"event: {eventType}\ndata: {json.dumps(data)}\n\n"
+
+        def generateEvents():
+            # Sample timestamps already sent to the client:
+            sent = {}
+            lastStatus = None
+            while True:
+                events = []
+                with lock:
+                    for name, sample in job.samples.items():
+                        if name not in sent or sent[name] < sample["timestamp"]:
+                            sent[name] = sample["timestamp"]
+                            events.append(serverSentEvent("sample", { "name": name, **sampleToJson(sample) }))
+                    status = getJobStatus(job)
+                    if status != lastStatus:
+                        lastStatus = status
+                        events.append(serverSentEvent("status", status))
+                    job.last_fetch_time = datetime.timestamp(datetime.now())
+                    if len(events) == 0 and status["in_progress"]:
+                        if not job_updated.wait(timeout=stream_keepalive):
+                            # Comment lines are ignored by clients, but keep idle connections open:
+                            events.append(": keep-alive\n\n")
+                for event in events:
+                    yield event
+                if not status["in_progress"] and len(events) == 0:
+                    return
+
+        return Response(stream_with_context(generateEvents()), mimetype="text/event-stream",
+                headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
+
+    # Request a single sample image as binary image file data:
+    @app.route("/jobs/<jobId>/samples/<sampleName>", methods=["GET"])
+    @cross_origin()
+    def get_sample(jobId, sampleName):
+        with current_app.lock:
+            job = getJobOr404(jobId)
+            if sampleName not in job.samples:
+                abort(make_response({"error": f"No sample {sampleName} found for job {jobId}"}, 404))
+            sample = job.samples[sampleName]
+            job.last_fetch_time = datetime.timestamp(datetime.now())
+        response = send_file(io.BytesIO(sample["image"]), mimetype=f"image/{sample['format'].lower()}")
+        response.headers["X-Sample-Timestamp"] = str(sample["timestamp"])
+        return response
+
+    # Cancel a queued or running job:
+    @app.route("/jobs/<jobId>", methods=["DELETE"])
+    @cross_origin()
+    def cancel_job(jobId):
+        with current_app.lock:
+            job = getJobOr404(jobId)
+            if not job.is_done():
+                job.cancelled = True
+                if job.status == 'queued':
+                    current_app.queue.remove(job)
+                    job.params = None
+                # Running jobs stop receiving samples immediately, but their rows stay in the shared model batch until
+                # that batch finishes, unless every job in it was cancelled. They're left out of any later batches.
+                # Other jobs in a merged group may keep running, so clients shouldn't wait for the group to finish:
+                job.status = 'cancelled'
+                job.finish_time = datetime.timestamp(datetime.now())
+                current_app.job_updated.notify_all()
+        return jsonify(success=True)
+
     return app
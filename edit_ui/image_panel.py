@@ -25,6 +25,10 @@ class ImagePanel(QWidget):
             Opens a file selection dialog to load a new image.
         imagReloadButton : QPushButton
             (Re)loads the image from the path in the fileTextBox.
+        undoButton : QPushButton
+            Reverts the last change to the image.
+        redoButton : QPushButton
+            Reapplies the last undone change to the image.
     """
 
     def __init__(self, pilImage=None, selectionSize=QSize(256, 256), scaleEnabled = True):
@@ -160,6 +164,16 @@ class ImagePanel(QWidget):
                 print(f"Saving image failed: {err}")
         self.saveButton.clicked.connect(saveImage)
 
+        self.undoButton = QPushButton(self)
+        self.undoButton.setText("Undo")
+        self.undoButton.setToolTip("Undo the last change to the image")
+        self.undoButton.clicked.connect(lambda: self.imageViewer.undo())
+
+        self.redoButton = QPushButton(self)
+        self.redoButton.setText("Redo")
+        self.redoButton.setToolTip("Redo the last undone change to the image")
+        self.redoButton.clicked.connect(lambda: self.imageViewer.redo())
+
         self.layout = QGridLayout()
         self.borderSize = 4
         def makeSpacer():
@@ -168,7 +182,7 @@ class ImagePanel(QWidget):
         self.layout.addItem(makeSpacer(), 3, 0, 1, 1)
         self.layout.addItem(makeSpacer(), 0, 0, 1, 1)
         self.layout.addItem(makeSpacer(), 0, 6, 1, 1)
-        self.layout.addWidget(self.imageViewer, 1, 1, 1, 14)
+        self.layout.addWidget(self.imageViewer, 1, 1, 1, 16)
         self.layout.addWidget(self.fileSelectButton, 2, 1, 1, 1)
         self.layout.addWidget(QLabel(self, text="Image path:"), 2, 2, 1, 1)
         self.layout.addWidget(self.fileTextBox, 2, 3, 1, 1)
@@ -186,6 +200,8 @@ class ImagePanel(QWidget):
 
         self.layout.addWidget(self.imgReloadButton, 2, 12, 1, 1)
         self.layout.addWidget(self.saveButton, 2, 13, 1, 1)
+        self.layout.addWidget(self.undoButton, 2, 14, 1, 1)
+        self.layout.addWidget(self.redoButton, 2, 15, 1, 1)
 
         self.layout.setRowMinimumHeight(1, 300)
         self.layout.setColumnStretch(3, 255)
@@ -0,0 +1,154 @@
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QRect, QSize, pyqtSignal
+from collections import OrderedDict
+import math
+
+class _TileSignals(QObject):
+    """Carries finished tiles from worker threads back to the GUI thread."""
+    finished = pyqtSignal(object, int, QImage)
+
+class _TileJob(QRunnable):
+    """
+    Creates one tile image on a worker thread by copying and downscaling part of the source image. The image must be
+    a copy only used by this job: QImage is reentrant, not thread-safe, so the GUI thread can't paint on the same
+    instance while the worker reads it. Copies share data, and painting on the original detaches it instead.
+    """
+
+    def __init__(self, signals, image, key, version, sourceRect, tileSize):
+        super().__init__()
+        self._signals = signals
+        self._image = image
+        self._key = key
+        self._version = version
+        self._sourceRect = sourceRect
+        self._tileSize = tileSize
+
+    def run(self):
+        tile = self._image.copy(self._sourceRect)
+        if tile.size() != self._tileSize:
+            tile = tile.scaled(self._tileSize, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        self._signals.finished.emit(self._key, self._version, tile)
+
+class ImageTilePyramid(QObject):
+    """
+    Multi-resolution tile cache used to draw large images quickly at any scale.
+
+    Level 0 holds full-resolution tiles, and each following level halves the resolution, until the whole image fits
+    in one tile. Tiles are created on request on worker threads, and only the most recently used tiles are kept.
+    Drawing only needs the visible tiles at a single level, so drawing time depends on the widget's size instead of
+    the image's size.
+    ...
+    Attributes:
+    -----------
+    tileReady : pyqtSignal()
+        Signal that fires whenever a requested tile finishes loading.
+    """
+    tileReady = pyqtSignal()
+
+    def __init__(self, image, tileSize=256, maxTiles=256):
+        """
+        Parameters:
+        -----------
+        image : QImage
+            Source image. Call invalidate whenever part of it changes.
+        tileSize : int, default 256
+            Width and height in pixels of each tile.
+        maxTiles : int, default 256
+            Maximum number of tiles kept in memory.
+        """
+        super().__init__()
+        self._image = image
+        self._tileSize = tileSize
+        self._maxTiles = maxTiles
+        self._tiles = OrderedDict()
+        self._pending = set()
+        self._versions = {}
+        self._threadPool = QThreadPool(self)
+        self._threadPool.setMaxThreadCount(2)
+        self._signals = _TileSignals()
+        self._signals.finished.connect(self._onTileFinished)
+        largestSide = max(image.width(), image.height(), 1)
+        self._levelCount = max(1, math.ceil(math.log2(largestSide / tileSize)) + 1)
+
+    def imageSize(self):
+        """Returns the size of the source image."""
+        return self._image.size()
+
+    def levelCount(self):
+        """Returns the number of resolution levels."""
+        return self._levelCount
+
+    def levelForScale(self, scale):
+        """Returns the lowest-resolution level that is still at least as detailed as the image drawn at scale."""
+        if scale <= 0:
+            return self._levelCount - 1
+        level = math.floor(math.log2(1 / scale)) if scale < 1 else 0
+        return min(max(level, 0), self._levelCount - 1)
+
+    def tileImageRect(self, level, col, row):
+        """Returns the area of the full-resolution image covered by a tile."""
+        span = self._tileSize * (2 ** level)
+        return QRect(col * span, row * span, span, span).intersected(self._image.rect())
+
+    def tilesInRect(self, level, imageRect):
+        """Returns (col, row) coordinates of all tiles at a level that overlap an area of the full-resolution image."""
+        imageRect = imageRect.intersected(self._image.rect())
+        if imageRect.isEmpty():
+            return []
+        span = self._tileSize * (2 ** level)
+        return [(col, row)
+                for row in range(imageRect.top() // span, imageRect.bottom() // span + 1)
+                for col in range(imageRect.left() // span, imageRect.right() // span + 1)]
+
+    def cachedTile(self, level, col, row):
+        """Returns the QPixmap for a tile if it's already loaded, or None, without queueing it for loading."""
+        key = (level, col, row)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        return None
+
+    def getTile(self, level, col, row):
+        """
+        Returns the QPixmap for a tile, or None if it isn't loaded yet. Missing tiles are queued for loading, and
+        tileReady fires once they're available.
+        """
+        key = (level, col, row)
+        tile = self.cachedTile(level, col, row)
+        if tile is not None:
+            return tile
+        if key not in self._pending:
+            sourceRect = self.tileImageRect(level, col, row)
+            if sourceRect.isEmpty():
+                return None
+            scale = 2 ** level
+            tileSize = QSize(max(1, math.ceil(sourceRect.width() / scale)),
+                    max(1, math.ceil(sourceRect.height() / scale)))
+            self._pending.add(key)
+            self._threadPool.start(_TileJob(self._signals, QImage(self._image), key, self._versions.get(key, 0),
+                    sourceRect, tileSize))
+        return None
+
+    def invalidate(self, changedRect):
+        """Discards all tiles covering a changed area of the source image, so they are recreated when next drawn."""
+        for level in range(self._levelCount):
+            for col, row in self.tilesInRect(level, changedRect):
+                key = (level, col, row)
+                self._tiles.pop(key, None)
+                self._pending.discard(key)
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clearQueue(self):
+        """Cancels tile loading that hasn't started yet, e.g. because the tiles are no longer visible."""
+        self._threadPool.clear()
+        self._pending.clear()
+
+    def _onTileFinished(self, key, version, tile):
+        # Tiles created before their area last changed are outdated:
+        if version != self._versions.get(key, 0):
+            return
+        self._pending.discard(key)
+        self._tiles[key] = QPixmap.fromImage(tile)
+        while len(self._tiles) > self._maxTiles:
+            self._tiles.popitem(last=False)
+        self.tileReady.emit()
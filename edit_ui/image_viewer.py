@@ -1,13 +1,19 @@
 from PyQt5 import QtWidgets
 from PyQt5.QtGui import QPainter, QPen, QImage
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize, pyqtSignal
-import PyQt5.QtGui as QtGui
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF, QSize, pyqtSignal
 from PIL import Image
 from edit_ui.ui_utils import getScaledPlacement, qImageToImage, imageToQImage, QEqualMargins
+from edit_ui.image_tiles import ImageTilePyramid
+from edit_ui.undo_history import RegionUndoHistory
 
 class ImageViewer(QtWidgets.QWidget):
     """
     QWidget that shows the image being edited, and allows the user to select sections.
+
+    The mouse wheel zooms in and out, and dragging with the middle mouse button pans the zoomed image. The image is
+    drawn from a tile pyramid (see ImageTilePyramid), so only visible tiles at a resolution close to the display
+    resolution are drawn, and very large images stay responsive. Inserted images can be undone and redone, with only
+    the changed regions kept in the history (see RegionUndoHistory).
     ...
     Attributes:
     -----------
@@ -19,7 +25,8 @@ class ImageViewer(QtWidgets.QWidget):
 
     def __init__( self,
             pilImage=None,
-            selectionSize = QSize(256, 256)):
+            selectionSize = QSize(256, 256),
+            undoMemoryLimit = 256 * 1024 * 1024):
         """
         Parameters:
         -----------
@@ -27,6 +34,8 @@ class ImageViewer(QtWidgets.QWidget):
             An initial pillow Image object to load.
         selectionSize : QSize, default QSize(256, 256)
             Size in pixels of selected image sections used for inpainting.
+        undoMemoryLimit : int, default 256MiB
+            Maximum bytes of image data kept for undoing changes, the oldest changes are discarded past this limit.
         """
         super().__init__()
         assert pilImage is None or isinstance(pilImage, Image.Image)
@@ -35,6 +44,13 @@ class ImageViewer(QtWidgets.QWidget):
         self._selectionSize = selectionSize
         self._borderSize = 4
         self._selected = QPoint(0, 0)
+        self._zoom = 1.0
+        self._maxDisplayScale = 8.0
+        self._viewCenter = QPointF(0, 0)
+        self._panStart = None
+        # Tile level and visible area drawn last, tiles queued for anything else are no longer needed:
+        self._lastTileView = None
+        self._history = RegionUndoHistory(self._applyRegion, undoMemoryLimit)
         if pilImage is not None:
             self.setImage(pilImage)
 
@@ -77,7 +93,12 @@ class ImageViewer(QtWidgets.QWidget):
         else:
             print("ImageViewer.setImage: image was not a string, QImage, or PIL Image")
             return
-        self._pixmap = QtGui.QPixmap.fromImage(self._qimage)
+        if not hasattr(self, '_tiles') or self._tiles.imageSize() != self._qimage.size():
+            self._zoom = 1.0
+            self._viewCenter = QPointF(self._qimage.width() / 2, self._qimage.height() / 2)
+        self._tiles = ImageTilePyramid(self._qimage)
+        self._tiles.tileReady.connect(self.update)
+        self._history.clear()
         self.resizeEvent(None)
         if not hasattr(self, '_selected'):
             self._selected = QPoint(0, 0)
@@ -120,12 +141,36 @@ class ImageViewer(QtWidgets.QWidget):
             self.update()
 
     def insertIntoSelection(self, inserted_image):
-        """Pastes a pillow image object onto the image at the selected coordinates."""
+        """
+        Pastes a pillow image object onto the image at the selected coordinates. Only the changed region of the image
+        and the display tiles covering it are updated, so this stays fast on large images. The change can be reverted
+        with undo.
+        """
         assert isinstance(inserted_image, Image.Image)
         if hasattr(self, '_selected') and hasattr(self, '_qimage'):
-            pilImage = qImageToImage(self._qimage)
-            pilImage.paste(inserted_image, (self._selected.x(), self._selected.y()))
-            self.setImage(pilImage)
+            insertedQImage = imageToQImage(inserted_image)
+            changedRect = QRect(self._selected, insertedQImage.size()).intersected(self._qimage.rect())
+            before = self._qimage.copy(changedRect)
+            self._applyRegion(None, QRect(self._selected, insertedQImage.size()), insertedQImage)
+            self._history.push(None, changedRect, before, self._qimage.copy(changedRect))
+
+    def undo(self):
+        """Reverts the most recent change to the image, returning False if there was nothing to undo."""
+        return self._history.undo()
+
+    def redo(self):
+        """Reapplies the most recently undone change, returning False if there was nothing to redo."""
+        return self._history.redo()
+
+    def _applyRegion(self, target, rect, image):
+        """Replaces part of the image, updating the affected display tiles."""
+        painter = QPainter(self._qimage)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(rect.topLeft(), image)
+        painter.end()
+        self._tiles.invalidate(rect)
+        self.onSelection.emit(self._selected, self._selectionSize)
+        self.update()
 
     def getSelectedSection(self):
         """Gets a copy of the image, cropped to the current selection area."""
@@ -155,12 +200,73 @@ class ImageViewer(QtWidgets.QWidget):
         return QPoint(int((point.x() - self._imageRect.x()) / scale),
                 int((point.y() - self._imageRect.y()) / scale))
 
+    def _fitRect(self):
+        """Returns the placement of the whole image within the widget when not zoomed in."""
+        return getScaledPlacement(QRect(QPoint(0, 0), self.size()), self._qimage.size(), self._borderSize)
+
+    def _updateImageRect(self):
+        """Places the image within the widget, applying the current zoom level and view center."""
+        fitRect = self._fitRect()
+        scale = fitRect.width() / self._qimage.width() * self._zoom
+        if scale <= 0:
+            self._imageRect = fitRect
+            return
+        # Keep the view center far enough from the image edges that the view stays within the image:
+        halfWidth = min(fitRect.width() / scale / 2, self._qimage.width() / 2)
+        halfHeight = min(fitRect.height() / scale / 2, self._qimage.height() / 2)
+        self._viewCenter = QPointF(
+                min(max(self._viewCenter.x(), halfWidth), self._qimage.width() - halfWidth),
+                min(max(self._viewCenter.y(), halfHeight), self._qimage.height() - halfHeight))
+        center = QRectF(fitRect).center()
+        self._imageRect = QRect(int(center.x() - self._viewCenter.x() * scale),
+                int(center.y() - self._viewCenter.y() * scale),
+                int(self._qimage.width() * scale),
+                int(self._qimage.height() * scale))
+
+    def _drawTiles(self, painter):
+        """Draws the visible part of the image, using tiles at the lowest resolution that still looks sharp."""
+        scale = self._imageRect.width() / self._qimage.width()
+        visibleRect = QRect(self._widgetToImageCoords(QPoint(0, 0)),
+                self._widgetToImageCoords(QPoint(self.width(), self.height())))
+        level = self._tiles.levelForScale(scale)
+        tileView = (self._tiles, level, visibleRect)
+        if tileView != self._lastTileView:
+            self._tiles.clearQueue()
+            self._lastTileView = tileView
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for col, row in self._tiles.tilesInRect(level, visibleRect):
+            tileRect = self._tiles.tileImageRect(level, col, row)
+            # Until a tile is loaded, draw the matching part of an already loaded lower-resolution tile in its place:
+            for fallbackLevel in range(level, self._tiles.levelCount()):
+                shift = fallbackLevel - level
+                if fallbackLevel == level:
+                    pixmap = self._tiles.getTile(level, col, row)
+                else:
+                    pixmap = self._tiles.cachedTile(fallbackLevel, col >> shift, row >> shift)
+                if pixmap is None:
+                    continue
+                fallbackRect = self._tiles.tileImageRect(fallbackLevel, col >> shift, row >> shift)
+                fallbackScale = 2 ** fallbackLevel
+                sourceRect = QRectF((tileRect.x() - fallbackRect.x()) / fallbackScale,
+                        (tileRect.y() - fallbackRect.y()) / fallbackScale,
+                        tileRect.width() / fallbackScale,
+                        tileRect.height() / fallbackScale)
+                targetRect = QRectF(self._imageRect.x() + tileRect.x() * scale,
+                        self._imageRect.y() + tileRect.y() * scale,
+                        tileRect.width() * scale,
+                        tileRect.height() * scale)
+                painter.drawPixmap(targetRect, pixmap, sourceRect)
+                break
+
     def paintEvent(self, event):
         """Draw the image, selection area, and border."""
         if not hasattr(self, '_qimage'):
             return
         painter = QPainter(self)
-        painter.drawPixmap(self._imageRect, self._pixmap)
+        painter.save()
+        painter.setClipRect(QRect(QPoint(0, 0), self.size()).marginsRemoved(QEqualMargins(self._borderSize)))
+        self._drawTiles(painter)
+        painter.restore()
 
         painter.setPen(QPen(Qt.black, self._borderSize, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
         margin = self._borderSize // 2
@@ -175,15 +281,41 @@ class ImageViewer(QtWidgets.QWidget):
             painter.drawRect(selectedRect)
 
     def mousePressEvent(self, event):
-        """Select the arean in the image to be edited."""
+        """Select the arean in the image to be edited, or start panning with the middle mouse button."""
         if event.button() == Qt.LeftButton and hasattr(self, '_qimage'):
             imageCoords = self._widgetToImageCoords(event.pos())
             self.setSelection(imageCoords)
             self.update()
+        elif event.button() == Qt.MiddleButton and hasattr(self, '_qimage'):
+            self._panStart = (event.pos(), QPointF(self._viewCenter))
+
+    def mouseMoveEvent(self, event):
+        """Pan the zoomed image while the middle mouse button is held."""
+        if (event.buttons() & Qt.MiddleButton) and self._panStart is not None and hasattr(self, '_qimage'):
+            startPos, startCenter = self._panStart
+            scale = self._imageRect.width() / self._qimage.width()
+            self._viewCenter = startCenter - QPointF(event.pos() - startPos) / scale
+            self._updateImageRect()
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.MiddleButton:
+            self._panStart = None
+
+    def wheelEvent(self, event):
+        """Zoom in or out, keeping the image point under the cursor in place."""
+        steps = event.angleDelta().y() / 120
+        if not hasattr(self, '_qimage') or steps == 0:
+            return
+        anchor = QPointF(self._widgetToImageCoords(event.pos()))
+        fitScale = self._fitRect().width() / self._qimage.width()
+        lastZoom = self._zoom
+        self._zoom = min(max(self._zoom * (1.25 ** steps), 1.0), max(1.0, self._maxDisplayScale / fitScale))
+        self._viewCenter = anchor - (anchor - self._viewCenter) * (lastZoom / self._zoom)
+        self._updateImageRect()
+        self.update()
 
     def resizeEvent(self, event):
         if not hasattr(self, '_qimage') or not isinstance(self._qimage, QImage):
             return
-        self._imageRect = getScaledPlacement(QRect(QPoint(0, 0), self.size()), self._qimage.size(), self._borderSize)
-        self._pixmap = QtGui.QPixmap.fromImage(self._qimage)
-        self._pixmap = self._pixmap.scaled(self._imageRect.size())
+        self._updateImageRect()
@@ -1,34 +1,78 @@
 from PyQt5 import QtWidgets
-from PyQt5.QtGui import QPainter, QPen, QImage
-from PyQt5.QtCore import Qt, QPoint, QSize, QRect, QBuffer
+from PyQt5.QtGui import QPainter, QPen, QImage, QPolygonF
+from PyQt5.QtCore import Qt, QPoint, QPointF, QSize, QRect
 import PyQt5.QtGui as QtGui
 from PIL import Image
 from edit_ui.ui_utils import getScaledPlacement, imageToQImage, qImageToImage, QEqualMargins
 
+class _Stroke():
+    """
+    One brush stroke or clear operation on the mask or sketch, in pixel coordinates of the selection size it was
+    drawn at.
+    """
+
+    def __init__(self, sketchMode, selectionSize=None, brushSize=0, color=None, eraser=False, clear=False):
+        self.sketchMode = sketchMode
+        self.selectionSize = selectionSize
+        self.brushSize = brushSize
+        self.color = color
+        self.eraser = eraser
+        self.clear = clear
+        self.points = QPolygonF()
+
+    def paint(self, painter, size):
+        """
+        Draws the stroke onto a layer of the given size, stretching it from the selection size it was drawn at in the
+        same way that the layer's flattened strokes are stretched.
+        """
+        painter.save()
+        if self.clear:
+            painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            painter.fillRect(QRect(QPoint(0, 0), size), Qt.transparent)
+        else:
+            painter.scale(size.width() / self.selectionSize.width(), size.height() / self.selectionSize.height())
+            painter.setCompositionMode(QPainter.CompositionMode_Clear if self.eraser
+                    else QPainter.CompositionMode_SourceOver)
+            painter.setPen(QPen(self.color, self.brushSize, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+            painter.drawPolyline(self.points)
+        painter.restore()
+
 class MaskCreator(QtWidgets.QWidget):
     """
     QWidget that shows the selected portion of the edited image, and lets the user draw a mask for inpainting.
+
+    Brush strokes are stored as polylines in selection coordinates, and are only rasterized when needed: at display
+    resolution when painting the widget, and at the exact selection resolution in getMask and getSketch. Undo and
+    redo just move strokes between the stroke list and the redo list. Once there are more strokes than can be undone,
+    the oldest are flattened into a base image for their layer, so rasterizing doesn't get slower over time. If the
+    selection size changes, base images and strokes drawn at the old size are both stretched to the new size.
     """
 
-    def __init__(self, pilImage):
+    def __init__(self, pilImage, maxUndoStrokes=200):
         """
         Parameters:
         pilImage : Image, optional
             Initial image area selected for editing.
+        maxUndoStrokes : int, default 200
+            Number of strokes and clears that can be undone.
         """
         super().__init__()
         assert pilImage is None or isinstance(pilImage, Image.Image)
-        
+
         self._drawing = False
-        self._lastPoint = QPoint()
         self._brushSize = 40
         self._selectionSize = QSize(0, 0)
+        self._imageRect = QRect(0, 0, self.width(), self.height())
         self._useEraser=False
-        self._maskCanvas = None
-        self._sketchCanvas = None
+        self._strokes = []
+        self._redoStrokes = []
+        self._maxUndoStrokes = maxUndoStrokes
+        # Strokes too old to undo, rasterized at selection resolution and keyed by sketch mode:
+        self._baseLayers = {}
+        # Display resolution rasterized layers, keyed by sketch mode:
+        self._layerCache = {}
         self._sketchMode=False
         self._sketchColor = Qt.black
-        self._hasSketch=False
         if pilImage is not None:
             self.loadImage(pilImage)
 
@@ -63,30 +107,35 @@ class MaskCreator(QtWidgets.QWidget):
         return self._brushSize
 
     def clear(self):
-        if self._sketchMode:
-            if self._sketchCanvas is not None:
-                self._sketchCanvas.fill(Qt.transparent)
-                self._hasSketch = False
-        elif self._maskCanvas is not None:
-            self._maskCanvas.fill(Qt.transparent)
+        if not self._canDraw():
+            return
+        self._addStroke(_Stroke(self._sketchMode, clear=True))
+        self._layerCache.pop(self._sketchMode, None)
+        self.update()
+
+    def undo(self):
+        """Reverts the most recent stroke or clear, returning False if there was nothing to undo."""
+        if self._drawing or len(self._strokes) == 0:
+            return False
+        stroke = self._strokes.pop()
+        self._redoStrokes.append(stroke)
+        self._layerCache.pop(stroke.sketchMode, None)
         self.update()
+        return True
+
+    def redo(self):
+        """Reapplies the most recently undone stroke or clear, returning False if there was nothing to redo."""
+        if self._drawing or len(self._redoStrokes) == 0:
+            return False
+        stroke = self._redoStrokes.pop()
+        self._strokes.append(stroke)
+        self._layerCache.pop(stroke.sketchMode, None)
+        self.update()
+        return True
 
     def loadImage(self, pilImage):
-        # Use a canvas that's large enough to look decent even editing scale changes,
-        # it'll just get resized to selection size on inpainting anyway.
-        canvasSize = QSize(512, 512)
-        if self._maskCanvas is None:
-            canvas_image = QImage(canvasSize, QtGui.QImage.Format_ARGB32)
-            self._maskCanvas = QtGui.QPixmap.fromImage(canvas_image)
-            self._maskCanvas.fill(Qt.transparent)
-        if self._sketchCanvas is None:
-            canvas_image = QImage(canvasSize, QtGui.QImage.Format_ARGB32)
-            self._sketchCanvas = QtGui.QPixmap.fromImage(canvas_image)
-            self._sketchCanvas.fill(Qt.transparent)
         if self._selectionSize != QSize(pilImage.width, pilImage.height):
             self._selectionSize = QSize(pilImage.width, pilImage.height)
-    
-
         self._imageRect = getScaledPlacement(QRect(QPoint(0, 0), self.size()), self._selectionSize,
                 self._borderSize())
         self._qimage = imageToQImage(pilImage)
@@ -100,49 +149,54 @@ class MaskCreator(QtWidgets.QWidget):
         painter.drawRect(self._imageRect.marginsAdded(QEqualMargins(self._borderSize())))
         if hasattr(self, '_pixmap') and self._pixmap is not None:
             painter.drawPixmap(self._imageRect, self._pixmap)
-        if self._sketchCanvas is not None and self._hasSketch:
-            painter.drawPixmap(self._imageRect, self._sketchCanvas)
-        if hasattr(self, '_maskCanvas') and self._maskCanvas is not None:
+        if self._canDraw():
+            if self._hasSketch():
+                painter.drawPixmap(self._imageRect, self._getDisplayLayer(True))
             painter.setOpacity(0.6)
-            painter.drawPixmap(self._imageRect, self._maskCanvas)
+            painter.drawPixmap(self._imageRect, self._getDisplayLayer(False))
 
     def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton and (self._sketchMode and self._sketchCanvas is not None) \
-                or (not self._sketchMode and self._maskCanvas is not None):
+        if event.button() == Qt.LeftButton and self._canDraw():
             self._drawing = True
-            self._lastPoint = event.pos() - self._imageRect.topLeft()
+            color = self._sketchColor if self._sketchMode else Qt.red
+            self._strokes.append(_Stroke(self._sketchMode, QSize(self._selectionSize), self._brushSize, color,
+                    self._useEraser))
+            self._strokes[-1].points.append(self._widgetToSelectionCoords(event.pos()))
 
     def mouseMoveEvent(self, event):
-        if event.buttons() and Qt.LeftButton and self._drawing \
-                and (self._sketchMode and self._sketchCanvas is not None) \
-                or (not self._sketchMode and self._maskCanvas is not None):
-            painter = QPainter(self._sketchCanvas) if self._sketchMode else QPainter(self._maskCanvas)
-            color = self._sketchColor if self._sketchMode else Qt.red
-            if self._useEraser:
-                painter.setCompositionMode(QPainter.CompositionMode_Clear)
-            scaledBrushSize = self._imageRect.width() / self._selectionSize.width() * self._brushSize
-            painter.setPen(QPen(color, scaledBrushSize, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-            painter.drawLine(self._lastPoint, event.pos() - self._imageRect.topLeft())
-            self._lastPoint = event.pos() - self._imageRect.topLeft()
-            if self._sketchMode:
-                self._hasSketch = True
+        if (event.buttons() & Qt.LeftButton) and self._drawing:
+            stroke = self._strokes[-1]
+            lastPoint = stroke.points.last()
+            nextPoint = self._widgetToSelectionCoords(event.pos())
+            stroke.points.append(nextPoint)
+            # Add the new segment to the cached display layer instead of rasterizing the whole layer again:
+            if stroke.sketchMode in self._layerCache:
+                painter = QPainter(self._layerCache[stroke.sketchMode])
+                segment = _Stroke(stroke.sketchMode, stroke.selectionSize, stroke.brushSize, stroke.color,
+                        stroke.eraser)
+                segment.points.append(lastPoint)
+                segment.points.append(nextPoint)
+                segment.paint(painter, self._imageRect.size())
+                painter.end()
             self.update()
 
     def mouseReleaseEvent(self, event):
-        if event.button == Qt.LeftButton and self._drawing:
+        if event.button() == Qt.LeftButton and self._drawing:
             self._drawing = False
+            # Clicks that never moved don't draw anything:
+            stroke = self._strokes.pop()
+            if stroke.points.size() >= 2:
+                self._addStroke(stroke)
 
     def getMask(self):
-        if self._maskCanvas is None:
+        if not self._canDraw():
             return None
-        canvasImage = self._maskCanvas.toImage().scaled(self._selectionSize)
-        return qImageToImage(canvasImage)
+        return qImageToImage(self._renderLayer(False, self._selectionSize))
 
     def getSketch(self):
-        if self._sketchCanvas is None or not self._hasSketch:
+        if not self._canDraw() or not self._hasSketch():
             return None
-        canvasImage = self._sketchCanvas.toImage().scaled(self._selectionSize)
-        return qImageToImage(canvasImage)
+        return qImageToImage(self._renderLayer(True, self._selectionSize))
 
     def resizeEvent(self, event):
         if self._selectionSize == QSize(0, 0):
@@ -150,10 +204,66 @@ class MaskCreator(QtWidgets.QWidget):
         else:
             self._imageRect = getScaledPlacement(QRect(QPoint(0, 0), self.size()), self._selectionSize,
                     self._borderSize())
-        if self._maskCanvas:
-            self._maskCanvas = self._maskCanvas.scaled(self._imageRect.size())
-        if self._sketchCanvas:
-            self._sketchCanvas = self._sketchCanvas.scaled(self._imageRect.size())
+        self._layerCache = {}
+
+    def _canDraw(self):
+        """Returns whether the mask and sketch can be drawn yet, which requires a selected image area."""
+        return hasattr(self, '_qimage') and not self._selectionSize.isEmpty()
+
+    def _hasSketch(self):
+        """Checks if the sketch currently contains any strokes drawn since it was last cleared."""
+        for stroke in reversed(self._strokes):
+            if stroke.sketchMode and stroke.clear:
+                return False
+            if stroke.sketchMode and not stroke.eraser:
+                return True
+        return True in self._baseLayers
+
+    def _addStroke(self, stroke):
+        self._strokes.append(stroke)
+        self._redoStrokes = []
+        # Flatten strokes that can no longer be undone into the base layers:
+        while len(self._strokes) > self._maxUndoStrokes:
+            stroke = self._strokes.pop(0)
+            if stroke.clear:
+                self._baseLayers.pop(stroke.sketchMode, None)
+                continue
+            if stroke.sketchMode not in self._baseLayers:
+                base = QImage(self._selectionSize, QImage.Format_ARGB32_Premultiplied)
+                base.fill(Qt.transparent)
+                self._baseLayers[stroke.sketchMode] = base
+            base = self._baseLayers[stroke.sketchMode]
+            painter = QPainter(base)
+            stroke.paint(painter, base.size())
+            painter.end()
+
+    def _widgetToSelectionCoords(self, point):
+        scale = self._selectionSize.width() / max(self._imageRect.width(), 1)
+        return QPointF((point.x() - self._imageRect.x()) * scale, (point.y() - self._imageRect.y()) * scale)
+
+    def _renderLayer(self, sketchMode, size):
+        """Rasterizes the mask or sketch at any resolution, returning a transparent QImage."""
+        image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        strokes = [stroke for stroke in self._strokes if stroke.sketchMode == sketchMode]
+        # Nothing before the last clear is visible:
+        clearIndexes = [i for i, stroke in enumerate(strokes) if stroke.clear]
+        painter = QPainter(image)
+        if len(clearIndexes) > 0:
+            strokes = strokes[clearIndexes[-1] + 1:]
+        elif sketchMode in self._baseLayers:
+            painter.drawImage(QRect(QPoint(0, 0), size), self._baseLayers[sketchMode])
+        for stroke in strokes:
+            stroke.paint(painter, size)
+        painter.end()
+        return image
+
+    def _getDisplayLayer(self, sketchMode):
+        """Returns the mask or sketch rasterized at display resolution, rasterizing it only if it changed."""
+        if sketchMode not in self._layerCache:
+            self._layerCache[sketchMode] = QtGui.QPixmap.fromImage(
+                    self._renderLayer(sketchMode, self._imageRect.size()))
+        return self._layerCache[sketchMode]
 
     def _borderSize(self):
         return (min(self.width(), self.height()) // 40) + 1
@@ -54,6 +54,16 @@ class MaskPanel(QWidget):
             self.eraserCheckbox.setChecked(False)
         self.clearMaskButton.clicked.connect(clearMask)
 
+        self.undoButton = QPushButton(self)
+        self.undoButton.setText("Undo")
+        self.undoButton.setToolTip("Undo the last mask or sketch change")
+        self.undoButton.clicked.connect(lambda: self.maskCreator.undo())
+
+        self.redoButton = QPushButton(self)
+        self.redoButton.setText("Redo")
+        self.redoButton.setToolTip("Redo the last undone mask or sketch change")
+        self.redoButton.clicked.connect(lambda: self.maskCreator.redo())
+
         self.maskModeButton = QRadioButton(self)
         self.sketchModeButton = QRadioButton(self)
         self.maskModeButton.setText("Draw mask")
@@ -98,6 +108,8 @@ class MaskPanel(QWidget):
         self.layout.addWidget(self.clearMaskButton, 2, 4, 1, 2)
         self.layout.addWidget(self.maskModeButton, 3, 1, 1, 1)
         self.layout.addWidget(self.keepSketchCheckbox, 3, 2, 1, 1)
+        self.layout.addWidget(self.undoButton, 3, 4, 1, 1)
+        self.layout.addWidget(self.redoButton, 3, 5, 1, 1)
         self.layout.addWidget(self.sketchModeButton, 4, 1, 1, 1)
         self.layout.addWidget(self.colorPickerButton, 4, 2, 1, 1)
         self.layout.setRowMinimumHeight(1, 300)
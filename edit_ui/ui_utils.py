@@ -1,8 +1,7 @@
 from PIL import Image
 from PyQt5.QtWidgets import QMessageBox
 from PyQt5.QtGui import QImage
-from PyQt5.QtCore import QBuffer, QPoint, QRect, QSize, QMargins
-import io
+from PyQt5.QtCore import QPoint, QRect, QSize, QMargins
 
 """Adds general-purpose utility functions to reuse in UI code"""
 
@@ -16,13 +15,35 @@ def imageToQImage(pilImage):
                 QImage.Format_RGB888)
 
 def qImageToImage(qImage):
-    """Convert a PyQt5 QImage to a PIL image, in PNG format."""
+    """
+    Convert a PyQt5 QImage to a PIL image without encoding. Grayscale8 QImages become L images, QImages without
+    alpha channels become RGB images, and all other formats are converted to RGBA. Where PIL supports it, the
+    returned image shares the QImage's pixel data instead of copying it. Shared images are read-only, PIL copies them
+    before any changes are made, and later changes to the QImage copy its data instead of changing the PIL image.
+    """
     if isinstance(qImage, QImage):
-        buffer = QBuffer()
-        buffer.open(QBuffer.ReadWrite)
-        qImage.save(buffer, "PNG")
-        pil_im = Image.open(io.BytesIO(buffer.data()))
-        return pil_im
+        # A shallow copy, so that painting on the original detaches it from the shared data:
+        qImage = QImage(qImage)
+        if qImage.format() == QImage.Format_RGB888:
+            mode = 'RGB'
+        elif qImage.format() == QImage.Format_Grayscale8:
+            mode = 'L'
+        elif not qImage.hasAlphaChannel():
+            qImage = qImage.convertToFormat(QImage.Format_RGB888)
+            mode = 'RGB'
+        else:
+            qImage = qImage.convertToFormat(QImage.Format_RGBA8888)
+            mode = 'RGBA'
+        buffer = qImage.constBits()
+        buffer.setsize(qImage.bytesPerLine() * qImage.height())
+        pilImage = Image.frombuffer(mode, (qImage.width(), qImage.height()), buffer, 'raw', mode,
+                qImage.bytesPerLine(), 1)
+        # Mapped buffers don't keep the QImage alive, so the PIL image needs to. Copied pixels (e.g. in RGB images,
+        # which PIL stores with 4 bytes per pixel) shouldn't keep a reference, or painting on the original QImage
+        # would need to copy all of its data:
+        if pilImage.readonly:
+            pilImage._qImage = qImage
+        return pilImage
 
 def getScaledPlacement(containerRect, innerSize, marginWidth=0):
     """
@@ -0,0 +1,126 @@
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QRect
+import zlib
+
+class _RegionEntry():
+    """One undoable change: the contents of a rectangular region before and after the change."""
+
+    def __init__(self, target, rect, before, after, compress):
+        self.target = target
+        self.rect = QRect(rect)
+        self._compress = compress
+        self._before = self._pack(before)
+        self._after = self._pack(after)
+
+    def byteSize(self):
+        return len(self._before[0]) + len(self._after[0])
+
+    def before(self):
+        return self._unpack(self._before)
+
+    def after(self):
+        return self._unpack(self._after)
+
+    def _pack(self, image):
+        buffer = image.constBits()
+        buffer.setsize(image.bytesPerLine() * image.height())
+        data = bytes(buffer)
+        if self._compress:
+            data = zlib.compress(data, 1)
+        return (data, image.width(), image.height(), image.bytesPerLine(), image.format())
+
+    def _unpack(self, packed):
+        data, width, height, bytesPerLine, imageFormat = packed
+        if self._compress:
+            data = zlib.decompress(data)
+        # QImage doesn't copy or keep a reference to its buffer, so a copy is needed before data goes out of scope:
+        return QImage(data, width, height, bytesPerLine, imageFormat).copy()
+
+class RegionUndoHistory():
+    """
+    Undo/redo history for image edits that only stores the changed region of each edit.
+
+    Each entry holds the contents of one rectangle before and after a change, optionally zlib-compressed, so memory
+    use depends on the size of the edits instead of the size of the image. Once the stored entries exceed a memory
+    limit, the oldest entries are discarded.
+    """
+
+    def __init__(self, applyRegion, maxBytes=64 * 1024 * 1024, compress=True):
+        """
+        Parameters:
+        -----------
+        applyRegion : function(target, QRect rect, QImage image)
+            Called to undo or redo changes, should replace the rect region of target with image.
+        maxBytes : int, default 64MiB
+            Maximum number of bytes of stored image data. The most recent entry is always kept, even if larger.
+        compress : bool, default True
+            Whether stored image data is compressed. Compression is fast, and edited regions that are mostly empty or
+            uniform (e.g. masks) shrink considerably.
+        """
+        assert callable(applyRegion)
+        self._applyRegion = applyRegion
+        self._maxBytes = maxBytes
+        self._compress = compress
+        self._entries = []
+        self._index = 0
+        self._byteSize = 0
+
+    def push(self, target, rect, before, after):
+        """
+        Records a change that was already applied, discarding any changes that could have been redone.
+
+        Parameters:
+        -----------
+        target : object
+            Passed back to applyRegion when undoing or redoing the change, e.g. to identify a layer.
+        rect : QRect
+            Changed region.
+        before : QImage
+            Contents of rect before the change.
+        after : QImage
+            Contents of rect after the change.
+        """
+        if rect.isEmpty():
+            return
+        for entry in self._entries[self._index:]:
+            self._byteSize -= entry.byteSize()
+        del self._entries[self._index:]
+        entry = _RegionEntry(target, rect, before, after, self._compress)
+        self._entries.append(entry)
+        self._byteSize += entry.byteSize()
+        while self._byteSize > self._maxBytes and len(self._entries) > 1:
+            self._byteSize -= self._entries.pop(0).byteSize()
+        self._index = len(self._entries)
+
+    def canUndo(self):
+        return self._index > 0
+
+    def canRedo(self):
+        return self._index < len(self._entries)
+
+    def undo(self):
+        """Restores the region changed by the most recent change, returning False if there was nothing to undo."""
+        if not self.canUndo():
+            return False
+        self._index -= 1
+        entry = self._entries[self._index]
+        self._applyRegion(entry.target, entry.rect, entry.before())
+        return True
+
+    def redo(self):
+        """Reapplies the most recently undone change, returning False if there was nothing to redo."""
+        if not self.canRedo():
+            return False
+        entry = self._entries[self._index]
+        self._index += 1
+        self._applyRegion(entry.target, entry.rect, entry.after())
+        return True
+
+    def clear(self):
+        self._entries = []
+        self._index = 0
+        self._byteSize = 0
+
+    def byteSize(self):
+        """Returns the number of bytes of image data currently stored."""
+        return self._byteSize
@@ -174,6 +174,54 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # variance values used by p_mean_variance()
+        self.log_betas = np.log(betas)
+        self.fixed_large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # Schedule arrays copied to each device, see _get_schedule_tensor().
+        self._schedule_tensors = {}
+
+    def _get_schedule_tensor(self, name, device):
+        """
+        Get one of the 1-D schedule arrays as a tensor on the given device.
+
+        Each array is only copied to each device once, later calls return the
+        cached tensor.
+
+        :param name: the name of a numpy array attribute, e.g. "alphas_cumprod".
+        :param device: the device the tensor should be on.
+        :return: a 1-D float64 tensor.
+        """
+        key = (name, device)
+        if key not in self._schedule_tensors:
+            self._schedule_tensors[key] = th.from_numpy(getattr(self, name)).to(
+                device=device
+            )
+        return self._schedule_tensors[key]
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Same as _extract_into_tensor(), using the cached schedule tensor for an
+        array attribute name.
+        """
+        return _extract_into_tensor(
+            self._get_schedule_tensor(name, timesteps.device),
+            timesteps,
+            broadcast_shape,
+        )
+
+    def _extract_lerp(self, name, timesteps, broadcast_shape):
+        """
+        Same as _extract_into_tensor_lerp(), using the cached schedule tensor
+        for an array attribute name.
+        """
+        return _extract_into_tensor_lerp(
+            self._get_schedule_tensor(name, timesteps.device),
+            timesteps,
+            broadcast_shape,
+        )
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -183,11 +231,11 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        variance = 1.0 - self._extract("alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract(
+            "log_one_minus_alphas_cumprod", t, x_start.shape
         )
         return mean, variance, log_variance
 
@@ -206,8 +254,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape)
             * noise
         )
 
@@ -220,12 +268,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -272,10 +320,10 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log = self._extract(
+                    "posterior_log_variance_clipped", t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                max_log = self._extract("log_betas", t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -285,16 +333,16 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    "fixed_large_variance",
+                    "fixed_large_log_variance",
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -334,25 +382,21 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
-        return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
-            * x_t
-        )
+        return (
+            xprev - self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
+        ) / self._extract("posterior_mean_coef1", t, x_t.shape)
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -384,7 +428,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -572,8 +616,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -616,10 +660,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -738,7 +782,7 @@ class GaussianDiffusion:
 
         eps = model_output[:, :4]
         if cond_fn is not None:
-            alpha_bar = _extract_into_tensor_lerp(self.alphas_cumprod, t, x.shape)
+            alpha_bar = self._extract_lerp("alphas_cumprod", t, x.shape)
             eps = eps - th.sqrt(1 - alpha_bar) * cond_fn(x, t, **model_kwargs)
         return eps
 
@@ -748,7 +792,7 @@ class GaussianDiffusion:
         eps,
         t,
     ):
-        alpha_bar = _extract_into_tensor_lerp(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract_lerp("alphas_cumprod", t, x.shape)
         return (x - eps * th.sqrt(1 - alpha_bar)) / th.sqrt(alpha_bar)
 
     def pndm_transfer(
@@ -759,7 +803,7 @@ class GaussianDiffusion:
         t_2,
     ):
         pred_xstart = self.eps_to_pred_xstart(x, eps, t_1)
-        alpha_bar_prev = _extract_into_tensor_lerp(self.alphas_cumprod, t_2, x.shape)
+        alpha_bar_prev = self._extract_lerp("alphas_cumprod", t_2, x.shape)
         return pred_xstart * th.sqrt(alpha_bar_prev) + th.sqrt(1 - alpha_bar_prev) * eps
 
     def prk_sample(
@@ -906,6 +950,9 @@ class GaussianDiffusion:
         """
         Sample x_{t-1} from the model using fourth-order Pseudo Linear Multistep
         (https://openreview.net/forum?id=PlKWVd2yBkY).
+
+        If old_eps holds fewer than 3 entries, a lower-order Adams-Bashforth
+        step is taken instead, using all available entries.
         """
         if model_kwargs is None:
             model_kwargs = {}
@@ -918,7 +965,14 @@ class GaussianDiffusion:
             return x
 
         eps = self.get_eps(model, x, t, model_kwargs, cond_fn)
-        eps_prime = (55 * eps - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+        if len(old_eps) == 0:
+            eps_prime = eps
+        elif len(old_eps) == 1:
+            eps_prime = (3 * eps - old_eps[-1]) / 2
+        elif len(old_eps) == 2:
+            eps_prime = (23 * eps - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
+        else:
+            eps_prime = (55 * eps - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
 
         sample = self.pndm_transfer(x, eps_prime, t, t - 1)
         pred_xstart = self.eps_to_pred_xstart(x, eps, t)
@@ -938,11 +992,17 @@ class GaussianDiffusion:
         init_image=None,
         skip_timesteps=0,
         progress=False,
+        prk_warmup=True,
     ):
         """
         Use PLMS to sample from the model and yield intermediate samples from
         each timestep of PLMS.
         Same usage as p_sample_loop_progressive().
+
+        :param prk_warmup: if True, the first three steps use PRK, which needs
+                           four model evaluations per step. If False, they use
+                           lower-order linear multistep updates instead, which
+                           need one.
         """
         if device is None:
             device = next(model.parameters()).device
@@ -974,7 +1034,7 @@ class GaussianDiffusion:
         for i in indices:
             t = th.tensor([i] * shape[0], device=device)
             with th.no_grad():
-                if len(old_eps) < 3:
+                if len(old_eps) < 3 and prk_warmup:
                     out = self.prk_sample(
                         model,
                         img,
@@ -995,7 +1055,8 @@ class GaussianDiffusion:
                         cond_fn=cond_fn,
                         model_kwargs=model_kwargs,
                     )
-                    old_eps.pop(0)
+                    if len(old_eps) == 3:
+                        old_eps.pop(0)
                 old_eps.append(out["eps"])
                 yield out
                 img = out["sample"]
@@ -1031,6 +1092,159 @@ class GaussianDiffusion:
             final = sample
         return final["sample"]
 
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        prev_xstart=None,
+        prev_h=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+    ):
+        """
+        Sample x_{t-1} from the model using the second-order multistep
+        DPM-Solver++ (https://arxiv.org/abs/2211.01095).
+
+        :param prev_xstart: the x_0 prediction from the previous step. If None,
+                            a first-order step is taken instead.
+        :param prev_h: the log-SNR step size of the previous step.
+        :return: a dict containing the following keys:
+                 - 'sample': the next sample.
+                 - 'pred_xstart': a prediction of x_0.
+                 - 'h': the log-SNR step size of this step.
+        """
+        if model_kwargs is None:
+            model_kwargs = {}
+
+        def process_xstart(x):
+            if denoised_fn is not None:
+                x = denoised_fn(x)
+            if clip_denoised:
+                return x.clamp(-1, 1)
+            return x
+
+        eps = self.get_eps(model, x, t, model_kwargs, cond_fn)
+        pred_xstart = process_xstart(self.eps_to_pred_xstart(x, eps, t))
+
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
+        alpha, sigma = th.sqrt(alpha_bar), th.sqrt(1 - alpha_bar)
+        alpha_prev, sigma_prev = th.sqrt(alpha_bar_prev), th.sqrt(1 - alpha_bar_prev)
+        # h = lambda_{t-1} - lambda_t, where lambda is the half log-SNR. It is
+        # infinite on the last step, which is always first-order.
+        h = th.log(alpha_prev / sigma_prev) - th.log(alpha / sigma)
+
+        denoised = pred_xstart
+        if prev_xstart is not None:
+            r = prev_h / h
+            denoised = (1 + 1 / (2 * r)) * pred_xstart - (1 / (2 * r)) * prev_xstart
+        # Equivalent to the DPM-Solver++ update
+        #   sigma_prev / sigma * x - alpha_prev * (exp(-h) - 1) * denoised,
+        # written without exp(-h) so that it stays finite when sigma_prev is 0.
+        sample = (sigma_prev / sigma) * x + (alpha_prev - sigma_prev * alpha / sigma) * denoised
+        return {"sample": sample, "pred_xstart": pred_xstart, "h": h}
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        init_image=None,
+        skip_timesteps=0,
+        progress=False,
+    ):
+        """
+        Use DPM-Solver++ to sample from the model and yield intermediate samples
+        from each timestep. Only one model evaluation is needed per step, so
+        good results can be reached with 10-15 timesteps.
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        if init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            img = self.q_sample(init_image, my_t, img)
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        prev_xstart = None
+        prev_h = None
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                out = self.dpm_solver_sample(
+                    model,
+                    img,
+                    t,
+                    # The last step goes to alpha_bar = 1, where the
+                    # second-order correction is undefined.
+                    prev_xstart=prev_xstart if i > 0 else None,
+                    prev_h=prev_h,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                )
+                prev_xstart = out["pred_xstart"]
+                prev_h = out["h"]
+                yield out
+                img = out["sample"]
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++.
+        Same usage as p_sample_loop().
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+        ):
+            final = sample
+        return final["sample"]
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1219,15 +1433,17 @@ class GaussianDiffusion:
 
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
-    Extract values from a 1-D numpy array for a batch of indices.
+    Extract values from a 1-D numpy array or tensor for a batch of indices.
 
-    :param arr: the 1-D numpy array.
+    :param arr: the 1-D numpy array or tensor.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if not isinstance(arr, th.Tensor):
+        arr = th.from_numpy(arr)
+    res = arr.to(device=timesteps.device)[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
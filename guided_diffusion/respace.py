@@ -84,6 +84,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # timestep_map tensors shared by all wrapped models, see _WrappedModel.
+        self._map_tensors = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -108,25 +110,57 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model,
+            self.timestep_map,
+            self.rescale_timesteps,
+            self.original_num_steps,
+            map_tensors=self._map_tensors,
         )
 
+    def reachable_timesteps(self):
+        """
+        Return the sorted timesteps from the original process that wrapped
+        models can be called with: every retained timestep, plus the midpoints
+        between neighboring retained timesteps used by PRK half-steps.
+        """
+        steps = np.array(self.timestep_map, dtype=np.float32)
+        midpoints = (steps[:-1] + steps[1:]) / 2
+        return np.unique(np.concatenate([steps, midpoints])).tolist()
+
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
         return t
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(
+        self,
+        model,
+        timestep_map,
+        rescale_timesteps,
+        original_num_steps,
+        map_tensors=None,
+    ):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # timestep_map copied to each device and dtype, so it isn't rebuilt on
+        # every call. Models wrapped by the same diffusion share this cache.
+        self._map_tensors = map_tensors if map_tensors is not None else {}
+
+    def _get_map_tensor(self, device, dtype):
+        key = (device, dtype)
+        if key not in self._map_tensors:
+            self._map_tensors[key] = th.tensor(
+                self.timestep_map, device=device, dtype=dtype
+            )
+        return self._map_tensors[key]
 
     def __call__(self, x, ts, **kwargs):
         ts = ts.float()
         frac = ts.frac()
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        map_tensor = self._get_map_tensor(ts.device, ts.dtype)
         new_ts_1 = map_tensor[ts.floor().long()]
         new_ts_2 = map_tensor[ts.ceil().long()]
         new_ts = th.lerp(new_ts_1, new_ts_2, frac)
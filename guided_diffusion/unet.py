@@ -78,6 +78,34 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+ATTENTION_BACKENDS = ("einsum", "sdpa", "chunked")
+
+def attention(q, k, v, backend, mask=None, chunk_size=1024):
+    """
+    Apply scaled dot-product attention without the default einsum path.
+    :param q: a [B x T x C] tensor of queries.
+    :param k: a [B x S x C] tensor of keys.
+    :param v: a [B x S x C] tensor of values.
+    :param backend: "sdpa" to use torch's fused scaled_dot_product_attention,
+                    or "chunked" to process queries in chunks of chunk_size, so
+                    only a [B x chunk_size x S] weight matrix exists at once.
+    :param mask: an optional boolean tensor broadcastable to [B x T x S],
+                 False where attention is not allowed.
+    :return: a [B x T x C] tensor after attention.
+    """
+    if backend == "sdpa":
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    assert backend == "chunked", f"unknown attention backend {backend}"
+    scale = q.shape[-1] ** -0.5
+    out = th.empty_like(q)
+    for i in range(0, q.shape[1], chunk_size):
+        sim = einsum('b i d, b j d -> b i j', q[:, i:i + chunk_size], k) * scale
+        if exists(mask):
+            sim.masked_fill_(~mask[:, i:i + chunk_size] if mask.shape[1] > 1 else ~mask, -th.finfo(sim.dtype).max)
+        attn = th.softmax(sim.float(), dim=-1).type(sim.dtype)
+        out[:, i:i + chunk_size] = einsum('b i j, b j d -> b i d', attn, v)
+    return out
+
 class CrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
         super().__init__()
@@ -86,6 +114,13 @@ class CrossAttention(nn.Module):
 
         self.scale = dim_head ** -0.5
         self.heads = heads
+        self.attention_backend = "einsum"
+        self.attention_chunk_size = 1024
+        # When enabled, keys and values computed from a context tensor are kept and reused for as long as the same
+        # context tensor is passed in unmodified, so a request's text conditioning is only projected once per
+        # sampling run:
+        self.cache_context = False
+        self._context_cache = None
 
         self.to_q = Linear(query_dim, inner_dim, bias=False)
         self.to_k = Linear(context_dim, inner_dim, bias=False)
@@ -96,23 +131,45 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
-    def forward(self, x, context=None, mask=None):
+    def _keys_values(self, context):
         h = self.heads
-
-        q = self.to_q(x)
-        context = default(context, x)
-
         k = self.to_k(context)
         v = self.to_v(context)
+        return tuple(rearrange(t, 'b n (h d) -> (b h) n d', h=h) for t in (k, v))
+
+    def _cached_keys_values(self, context):
+        # Tensor versions change on in-place modification, so a modified context isn't mistaken for the cached one:
+        cache = self._context_cache
+        if cache is not None and cache[0] is context and cache[1] == context._version:
+            return cache[2:]
+        k, v = self._keys_values(context)
+        # Values that are part of an autograd graph can't be reused across steps:
+        if not (k.requires_grad or v.requires_grad):
+            self._context_cache = (context, context._version, k, v)
+        return k, v
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+    def forward(self, x, context=None, mask=None):
+        h = self.heads
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        q = rearrange(self.to_q(x), 'b n (h d) -> (b h) n d', h=h)
+        if context is not None and self.cache_context:
+            k, v = self._cached_keys_values(context)
+        else:
+            k, v = self._keys_values(default(context, x))
 
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
+
+        if self.attention_backend != "einsum":
+            out = attention(q, k, v, self.attention_backend, mask=mask, chunk_size=self.attention_chunk_size)
+            out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+            return self.to_out(out)
+
+        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+
+        if exists(mask):
+            max_neg_value = -th.finfo(sim.dtype).max
             sim.masked_fill_(~mask, max_neg_value)
 
         # attention, what we cannot get enough of
@@ -133,8 +190,11 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = LayerNorm(dim)
         self.norm3 = LayerNorm(dim)
         self.checkpoint = checkpoint
+        self.inference_mode = False
 
     def forward(self, x, context=None):
+        if self.inference_mode:
+            return self._forward(x, context)
         return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
 
     def _forward(self, x, context=None):
@@ -315,6 +375,7 @@ class ResBlock(TimestepBlock):
         self.use_conv = use_conv
         self.use_checkpoint = use_checkpoint
         self.use_scale_shift_norm = use_scale_shift_norm
+        self.inference_mode = False
 
         self.in_layers = nn.Sequential(
             normalization(channels),
@@ -365,6 +426,8 @@ class ResBlock(TimestepBlock):
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        if self.inference_mode:
+            return self._forward(x, emb)
         return checkpoint(
             self._forward, (x, emb), self.parameters(), self.use_checkpoint
         )
@@ -429,8 +492,11 @@ class AttentionBlock(nn.Module):
             self.attention = QKVAttentionLegacy(self.num_heads)
 
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
+        self.inference_mode = False
 
     def forward(self, x):
+        if self.inference_mode:
+            return self._forward(x)
         return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
@@ -471,6 +537,8 @@ class QKVAttention(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = "einsum"
+        self.attention_chunk_size = 1024
 
     def forward(self, qkv):
         """
@@ -482,6 +550,13 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if self.attention_backend != "einsum":
+            q, k, v = map(
+                lambda t: t.reshape(bs * self.n_heads, ch, length).transpose(1, 2),
+                (q, k, v),
+            )
+            a = attention(q, k, v, self.attention_backend, chunk_size=self.attention_chunk_size)
+            return a.transpose(1, 2).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -580,6 +655,10 @@ class UNetModel(nn.Module):
         self.conv_resample = conv_resample
         self.num_classes = num_classes
         self.use_checkpoint = use_checkpoint
+        self.inference_mode = False
+        self._clip_proj_cache = None
+        self._timestep_table = None
+        self._timestep_embeddings = {}
         self.dtype = th.float16 if use_fp16 else th.float32
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
@@ -780,6 +859,48 @@ class UNetModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+    def set_inference_mode(self, enabled=True, cache_context=None):
+        """
+        Enable or disable inference mode. In inference mode, blocks call their
+        forward functions directly instead of going through gradient
+        checkpointing, which only helps when gradients are needed.
+
+        Inference mode also caches conditioning that doesn't change between
+        sampling steps: cross-attention keys and values of the context, and the
+        projected clip embedding. Cached values are reused for as long as the
+        same context and clip_embed tensors are passed in, and haven't been
+        modified in place.
+        :param cache_context: whether to cache cross-attention keys and values,
+                              defaults to enabled. Disable this when compiling
+                              apply_blocks, as the cache checks and updates
+                              module state inside the compiled blocks.
+        """
+        if cache_context is None:
+            cache_context = enabled
+        self.inference_mode = enabled
+        self._clip_proj_cache = None
+        for module in self.modules():
+            if isinstance(module, (BasicTransformerBlock, ResBlock, AttentionBlock)):
+                module.inference_mode = enabled
+            elif isinstance(module, CrossAttention):
+                module.cache_context = enabled and cache_context
+                module._context_cache = None
+
+    def set_attention_backend(self, backend):
+        """
+        Select how attention layers are computed.
+        :param backend: "einsum" to materialize full attention weights,
+                        "sdpa" to use torch's fused scaled_dot_product_attention,
+                        or "chunked" to limit attention weight memory by
+                        processing queries in chunks.
+        """
+        assert backend in ATTENTION_BACKENDS, f"unknown attention backend {backend}"
+        if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            raise ValueError("the sdpa attention backend requires torch 2.0 or newer")
+        for module in self.modules():
+            if isinstance(module, (CrossAttention, QKVAttention)):
+                module.attention_backend = backend
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -818,6 +939,74 @@ class UNetModel(nn.Module):
 
         self.output_blocks.apply(convert_module_to_f32)
 
+    def set_timestep_table(self, timesteps):
+        """
+        Precompute time_embed outputs for a fixed set of timesteps, which are
+        then looked up instead of computed on every call. In inference mode,
+        the lookup runs entirely on the model's device without checking that
+        timesteps are in the table, as that would wait for the device on every
+        call, so the table must contain every timestep the model will be
+        called with. Outside inference mode, embeddings of timesteps missing
+        from the table are computed instead. Use
+        SpacedDiffusion.reachable_timesteps() when the model is only sampled
+        through that diffusion.
+        :param timesteps: a sequence of timestep values, or None to remove the
+                          table.
+        """
+        if timesteps is None:
+            self._timestep_table = None
+        else:
+            self._timestep_table = th.tensor(sorted(timesteps), dtype=th.float32)
+        self._timestep_embeddings = {}
+
+    def _get_timestep_embeddings(self, device):
+        """
+        Return the timestep table and its embeddings on a device, computing
+        them on first use.
+        """
+        if device not in self._timestep_embeddings:
+            table = self._timestep_table.to(device)
+            with th.no_grad():
+                t_emb = timestep_embedding(table, self.model_channels, repeat_only=False)
+                embeddings = self.time_embed(t_emb)
+            self._timestep_embeddings[device] = (table, embeddings)
+        return self._timestep_embeddings[device]
+
+    def _embed_timesteps(self, timesteps):
+        """
+        Apply timestep_embedding and time_embed to a batch of timesteps, using
+        the timestep table if there is one.
+        """
+        if self._timestep_table is not None:
+            table, embeddings = self._get_timestep_embeddings(timesteps.device)
+            idx = th.searchsorted(table, timesteps.float()).clamp(max=len(table) - 1)
+            if self.inference_mode:
+                return embeddings[idx]
+            # Checking for missing timesteps waits for the device, which only
+            # matters in inference mode:
+            missing = table[idx] != timesteps.float()
+            if not missing.any():
+                return embeddings[idx]
+            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+            return th.where(missing[:, None], self.time_embed(t_emb), embeddings[idx])
+        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+        return self.time_embed(t_emb)
+
+    def _project_clip_embed(self, clip_embed):
+        """
+        Apply clip_proj to a clip embedding. In inference mode, the result is
+        reused for as long as the same clip_embed tensor is passed in without
+        being modified.
+        """
+        cache = self._clip_proj_cache
+        if self.inference_mode and cache is not None and cache[0] is clip_embed \
+                and cache[1] == clip_embed._version:
+            return cache[2]
+        clip_proj = self.clip_proj(clip_embed)
+        if self.inference_mode and not clip_proj.requires_grad:
+            self._clip_proj_cache = (clip_embed, clip_embed._version, clip_proj)
+        return clip_proj
+
     def forward(self, x, timesteps=None, context=None, clip_embed=None, image_embed=None, super_res_embed=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
@@ -834,12 +1023,10 @@ class UNetModel(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         assert timesteps is not None, 'need to implement no-timestep usage'
-        hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        emb = self._embed_timesteps(timesteps)
 
         if clip_embed is not None:
-            emb = emb + self.clip_proj(clip_embed).to(emb)
+            emb = emb + self._project_clip_embed(clip_embed).to(emb)
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
@@ -848,6 +1035,21 @@ class UNetModel(nn.Module):
         if image_embed is not None:
             x = th.cat([x, image_embed], dim=1)
 
+        return self.apply_blocks(x, emb, context, super_res_embed)
+
+    def apply_blocks(self, x, emb, context=None, super_res_embed=None):
+        """
+        Apply the UNet blocks, after timestep and conditioning embeddings are
+        prepared. This is kept separate from forward so it can be compiled
+        without the cached embedding lookups done in forward.
+        :param x: an [N x C x ...] Tensor of inputs, including image_embed.
+        :param emb: an [N x D] Tensor of timestep and clip embeddings.
+        :param context: conditioning plugged in via crossattn
+        :param super_res_embed: image embeddings to be fed into the middle
+                                block (for upscaling)
+        :return: an [N x C x ...] Tensor of outputs.
+        """
+        hs = []
         h = x.type(self.dtype)
 
         for module in self.input_blocks:
@@ -36,7 +36,10 @@ model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normaliz
         clip_guidance = args.clip_guidance,
         cpu = args.cpu,
         ddpm = args.ddpm,
-        ddim = args.ddim)
+        ddim = args.ddim,
+        attention_backend = args.attention_backend,
+        compile_models = args.compile,
+        compile_cache_dir = args.compile_cache_dir)
 
 sample_fn, clip_score_fn = createSampleFunction(
         device,
@@ -65,7 +68,11 @@ sample_fn, clip_score_fn = createSampleFunction(
         clip_guidance_scale=args.clip_guidance_scale,
         skip_timesteps=args.skip_timesteps,
         ddpm=args.ddpm,
-        ddim=args.ddim)
+        ddim=args.ddim,
+        dpm_solver=args.dpm_solver,
+        fast_plms_warmup=args.fast_plms_warmup,
+        convergence_tolerance=args.convergence_tolerance,
+        crop_margin=args.crop_margin)
 
 gc.collect()
 generateSamples(device,
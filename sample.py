@@ -422,15 +422,14 @@ def do_run():
     }
 
     # Create a classifier-free guidance sampling function
+    # The sampler only tracks conditional entries, each model call runs them with both halves of kwargs.
     def model_fn(x_t, ts, **kwargs):
-        half = x_t[: len(x_t) // 2]
-        combined = torch.cat([half, half], dim=0)
-        model_out = model(combined, ts, **kwargs)
+        combined = torch.cat([x_t, x_t], dim=0)
+        model_out = model(combined, torch.cat([ts, ts], dim=0), **kwargs)
         eps, rest = model_out[:, :3], model_out[:, 3:]
         cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
         half_eps = uncond_eps + args.guidance_scale * (cond_eps - uncond_eps)
-        eps = torch.cat([half_eps, half_eps], dim=0)
-        return torch.cat([eps, rest], dim=1)
+        return torch.cat([half_eps, rest[:len(x_t)]], dim=1)
 
     cur_t = None
 
@@ -512,7 +511,7 @@ def do_run():
         init = init.resize((int(args.width),  int(args.height)), Image.LANCZOS)
         init = TF.to_tensor(init).to(device).unsqueeze(0).clamp(0,1)
         h = ldm.encode(init * 2 - 1).sample() *  0.18215
-        init = torch.cat(args.batch_size*2*[h], dim=0)
+        init = torch.cat(args.batch_size*[h], dim=0)
     else:
         init = None
 
@@ -525,7 +524,9 @@ def do_run():
 
         samples = sample_fn(
             model_fn,
-            (args.batch_size*2, 4, int(args.height/8), int(args.width/8)),
+            (args.batch_size, 4, int(args.height/8), int(args.width/8)),
+            # Drawn at twice the batch size so a given seed produces the same noise as full-width guidance sampling:
+            noise=torch.randn(args.batch_size*2, 4, int(args.height/8), int(args.width/8), device=device)[:args.batch_size],
             clip_denoised=False,
             model_kwargs=kwargs,
             cond_fn=cond_fn if args.clip_guidance else None,
@@ -0,0 +1,67 @@
+# Optionally compiles model functions with torch.compile for a fixed set of image sizes
+import torch
+import os
+
+# Image sizes (width, height) compiled by default:
+DEFAULT_COMPILE_SIZES = [(256, 256), (256, 192), (192, 256), (512, 512)]
+
+def enableCompileCache(cache_dir, model_hash):
+    """
+    Saves torch.compile artifacts to a subdirectory of cache_dir named after model_hash (see getModelHash), so
+    compiled code is reused across restarts with the same model weights. Input shapes are part of torch's own cache
+    keys, so each compiled image size is stored separately.
+    """
+    path = os.path.join(cache_dir, model_hash)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = path
+    try:
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+    except (ImportError, AttributeError) as err:
+        print(f'Warning: compiled graphs will not be cached on disk: {err}')
+
+class SizeBucketedCompile():
+    """
+    Wraps a function taking a batch of images or latents as its first parameter. Inputs matching one of a fixed set
+    of image sizes use a torch.compile version of the function, and all other inputs use the original function. This
+    limits compilation to known common sizes, instead of recompiling for every new size.
+
+    Batch sizes vary with the number of merged requests, so the batch dimension is compiled as a dynamic size, while
+    image sizes stay static. Each image size compiles at most twice, once for a batch size of 1 (which torch always
+    specializes) and once for all other batch sizes.
+    """
+
+    def __init__(self, fn, sizes, scale=1, backend='inductor'):
+        """
+        Parameters:
+        -----------
+        fn : function
+            Function to compile, its first parameter must be a tensor with height and width as its last dimensions.
+        sizes : list of (int width, int height)
+            Image sizes that should use the compiled function.
+        scale : int
+            Image pixels per input position, e.g. 8 for kl-f8 latents.
+        backend : str
+            torch.compile backend.
+        """
+        self.fn = fn
+        self.compiled_fn = torch.compile(fn, dynamic=False, backend=backend)
+        self.sizes = set(tuple(size) for size in sizes)
+        self.scale = scale
+        # Past this limit, torch silently falls back to the uncompiled function:
+        config = torch._dynamo.config
+        limitName = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+        setattr(config, limitName, max(getattr(config, limitName), 2 * len(self.sizes)))
+
+    def __call__(self, x, *args, **kwargs):
+        size = (x.shape[-1] * self.scale, x.shape[-2] * self.scale)
+        if size in self.sizes:
+            torch._dynamo.mark_static(x, -1)
+            torch._dynamo.mark_static(x, -2)
+            # Other batched inputs (e.g. embeddings) need a dynamic batch size too, or they'd still recompile:
+            for value in (x, *args, *kwargs.values()):
+                if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == x.shape[0]:
+                    torch._dynamo.maybe_mark_dynamic(value, 0)
+            return self.compiled_fn(x, *args, **kwargs)
+        return self.fn(x, *args, **kwargs)
@@ -7,57 +7,51 @@ from torchvision.transforms import functional as TF
 from torch.nn import functional as F
 from encoders.modules import MakeCutouts
 from startup.utils import fetch
+import hashlib
+from functools import partial
 import sys
 
-def createSampleFunction(
+def createConditioning(
         device,
-        model,
-        model_params, 
+        model_params,
         bert_model,
         clip_model,
-        clip_preprocess,
         ldm_model,
-        diffusion,
-        normalize,
-        image=None,
         mask=None,
         prompt="",
         negative="",
-        guidance_scale=5.0,
         batch_size=1,
         width=256,
         height=256,
-        cutn=16,
         edit=None,
         edit_width=None,
         edit_height=None,
         edit_x=0,
         edit_y=0,
-        clip_guidance=False,
-        clip_guidance_scale=None,
-        skip_timesteps=False,
-        ddpm=False,
-        ddim=False):
-    """
-    Creates a function that will generate a set of sample images, along with an accompanying clip ranking function.
+        embedding_cache=None,
+        latent_cache=None):
     """
-    # bert context
-    text_emb = bert_model.encode([prompt]*batch_size).to(device).float()
-    text_blank = bert_model.encode([negative]*batch_size).to(device).float()
+    Encodes text prompts and the edited image into the keyword arguments expected by the diffusion model.
 
-    text = clip.tokenize([prompt]*batch_size, truncate=True).to(device)
-    text_clip_blank = clip.tokenize([negative]*batch_size, truncate=True).to(device)
-
-
-    # clip context
-    text_emb_clip = clip_model.encode_text(text)
-    text_emb_clip_blank = clip_model.encode_text(text_clip_blank)
-    if clip_guidance and not clip_guidance_scale:
-        clip_guidance_scale = 150
-
-    make_cutouts = MakeCutouts(clip_model.visual.input_resolution, cutn)
-
-    text_emb_norm = text_emb_clip[0] / text_emb_clip[0].norm(dim=-1, keepdim=True)
+    Returned model_kwargs hold batch_size conditional entries followed by batch_size unconditional entries. The CLIP
+    text embedding of the prompt is also returned. Each prompt is only encoded once and then expanded to fill the
+    batch, and if an EmbeddingCache is provided, previously encoded prompts are not encoded again. Likewise, if
+    latent_cache is provided, edit images with identical content reuse their cached VAE latents.
+    """
+    def encodePrompt(text):
+        # bert context
+        bert_emb = bert_model.encode([text]).to(device).float()
+        # clip context
+        clip_emb = clip_model.encode_text(clip.tokenize([text], truncate=True).to(device))
+        return bert_emb, clip_emb
+    def getEmbeddings(text):
+        if embedding_cache is not None:
+            bert_emb, clip_emb = embedding_cache.get(text, encodePrompt, device)
+        else:
+            bert_emb, clip_emb = encodePrompt(text)
+        return bert_emb.expand(batch_size, *bert_emb.shape[1:]), clip_emb.expand(batch_size, *clip_emb.shape[1:])
+    text_emb, text_emb_clip = getEmbeddings(prompt)
+    text_blank, text_emb_clip_blank = getEmbeddings(negative)
 
     image_embed = None
 
@@ -80,9 +74,16 @@ def createSampleFunction(
             input_image_pil = Image.open(fetch(edit)).convert('RGB')
             input_image_pil = ImageOps.fit(input_image_pil, (w, h))
         if input_image_pil is not None:
-            np_image = transforms.ToTensor()(input_image_pil).unsqueeze(0).to(device)
-            np_image = 2 * np_image - 1
-            np_image = ldm_model.encode(np_image).sample()
+            def encodeImage(key):
+                np_image = transforms.ToTensor()(input_image_pil).unsqueeze(0).to(device)
+                np_image = 2 * np_image - 1
+                return (ldm_model.encode(np_image).sample(),)
+            if latent_cache is not None:
+                imageKey = hashlib.sha256(input_image_pil.tobytes())
+                imageKey.update(f'{input_image_pil.mode}:{input_image_pil.size}'.encode('utf-8'))
+                np_image, = latent_cache.get(imageKey.hexdigest(), encodeImage, device)
+            else:
+                np_image, = encodeImage(None)
 
         y = edit_y//8
         x = edit_x//8
@@ -103,8 +104,6 @@ def createSampleFunction(
             0 if y > 0 else -y:np_image.shape[2]-ycrop,
             0 if x > 0 else -x:np_image.shape[3]-xcrop
         ]
-        input_image_pil = ldm_model.decode(input_image)
-        input_image_pil = TF.to_pil_image(input_image_pil.squeeze(0).add(1).div(2).clamp(0, 1))
         input_image *= 0.18215
 
         if isinstance(mask, Image.Image):
@@ -132,17 +131,198 @@ def createSampleFunction(
         "clip_embed": torch.cat([text_emb_clip, text_emb_clip_blank], dim=0).float() if model_params['clip_embed_dim'] else None,
         "image_embed": image_embed
     }
+    return model_kwargs, text_emb_clip
+
+def getInpaintingMask(model_kwargs, batch_size):
+    """
+    Returns a (batch_size, 1, height, width) tensor of the latent positions being generated, with 1 where the model
+    fills in content. This matches what the model sees: masked image_embed positions are zero in every channel. If
+    there is no image_embed, every position is generated.
+    """
+    image_embed = model_kwargs.get("image_embed")
+    if image_embed is None:
+        return None
+    return (image_embed[:batch_size] == 0).all(dim=1, keepdim=True).float()
+
+def stopWhenConverged(samples, mask, tolerance, total_steps):
+    """
+    Yields samples from a progressive sampling generator until pred_xstart stops changing. Sampling ends once the
+    mean absolute change in pred_xstart between steps, measured within mask, is below tolerance for every batch entry.
+    The pred_xstart of the last sample yielded is then used as the final denoised result.
+
+    Parameters:
+    -----------
+    samples : generator
+        A progressive sample generator, such as diffusion.plms_sample_loop_progressive.
+    mask : Tensor or None
+        Latent positions to check for convergence, see getInpaintingMask. If None, all positions are checked.
+    tolerance : float
+        Mean absolute change in latent values below which sampling stops.
+    total_steps : int
+        Number of steps samples would produce if run to completion, used to report the number of steps skipped.
+    """
+    prev_xstart = None
+    for step, sample in enumerate(samples):
+        yield sample
+        xstart = sample['pred_xstart']
+        if prev_xstart is not None:
+            change = (xstart - prev_xstart).abs()
+            if mask is None:
+                change = change.mean(dim=(1, 2, 3))
+            else:
+                change = (change * mask).sum(dim=(1, 2, 3)) / (mask.sum(dim=(1, 2, 3)) * change.shape[1]).clamp(min=1)
+            if change.max().item() < tolerance:
+                if step + 1 < total_steps:
+                    print(f'Sample converged, stopping after {step + 1} of {total_steps} steps.')
+                return
+        prev_xstart = xstart
+
+def cropToMask(model, model_kwargs, batch_size, margin):
+    """
+    Finds the latent region that needs to be generated: the bounding box of all inpainted positions (see
+    getInpaintingMask), expanded by margin image pixels on each side for context and rounded up to a multiple of the
+    model's total downsampling factor. Returns model_kwargs with image_embed cropped to that region, along with the
+    region as (top, left, bottom, right) latent coordinates. If margin is None, or cropping wouldn't reduce the
+    generated area, model_kwargs are returned unchanged along with None.
+    """
+    mask = getInpaintingMask(model_kwargs, batch_size) if margin is not None else None
+    if mask is None:
+        return model_kwargs, None
+    mask = mask.amax(dim=(0, 1))
+    rows = mask.amax(dim=1).nonzero()
+    cols = mask.amax(dim=0).nonzero()
+    if len(rows) == 0:
+        return model_kwargs, None
+    margin = margin // 8
+    multiple = 2 ** (len(model.channel_mult) - 1)
+    def span(indices, size):
+        start = max(int(indices[0]) - margin, 0)
+        end = min(int(indices[-1]) + 1 + margin, size)
+        length = min(-(-(end - start) // multiple) * multiple, size)
+        start = min(start, size - length)
+        return start, start + length
+    top, bottom = span(rows, mask.shape[0])
+    left, right = span(cols, mask.shape[1])
+    if (bottom - top) * (right - left) == mask.numel():
+        return model_kwargs, None
+    box = (top, left, bottom, right)
+    return { **model_kwargs, "image_embed": cropLatent(model_kwargs["image_embed"], box) }, box
 
-    # Create a classifier-free guidance sampling function
+def cropLatent(latent, box):
+    """Crops a latent tensor to a (top, left, bottom, right) region. If latent or box is None, latent is returned."""
+    if latent is None or box is None:
+        return latent
+    top, left, bottom, right = box
+    return latent[:, :, top:bottom, left:right]
+
+def pasteCroppedSamples(samples, base, box):
+    """
+    Yields samples from a progressive sampling generator that runs on a cropped latent region, with their sample and
+    pred_xstart values pasted into copies of the full-size base latent at the (top, left, bottom, right) region box.
+    """
+    top, left, bottom, right = box
+    for sample in samples:
+        pasted = dict(sample)
+        for key in ('sample', 'pred_xstart'):
+            pasted[key] = base.clone()
+            pasted[key][:, :, top:bottom, left:right] = sample[key]
+        yield pasted
+
+def createGuidedModelFn(model, guidance_scale):
+    """
+    Creates a classifier-free guidance sampling function.
+
+    The sampler only tracks conditional batch entries. Each model call runs every entry twice, paired with the
+    conditional and unconditional halves of model_kwargs, and returns guided output for the conditional entries only,
+    so sampler state and arithmetic stay at the requested batch size.
+
+    guidance_scale may be a single float, or a tensor with one entry per conditional batch item, broadcastable
+    against the model output.
+    """
     def model_fn(x_t, ts, **kwargs):
-        half = x_t[: len(x_t) // 2]
-        combined = torch.cat([half, half], dim=0)
-        model_out = model(combined, ts, **kwargs)
+        combined = torch.cat([x_t, x_t], dim=0)
+        model_out = model(combined, torch.cat([ts, ts], dim=0), **kwargs)
         eps, rest = model_out[:, :3], model_out[:, 3:]
         cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
         half_eps = uncond_eps + guidance_scale * (cond_eps - uncond_eps)
-        eps = torch.cat([half_eps, half_eps], dim=0)
-        return torch.cat([eps, rest], dim=1)
+        return torch.cat([half_eps, rest[:len(x_t)]], dim=1)
+    return model_fn
+
+def createInitialNoise(batch_size, width, height, device):
+    """
+    Creates initial sampler noise for a batch. Noise is drawn for twice the batch size and the first half is kept,
+    matching the random values that sampling with separate unconditional batch entries would use for a given seed.
+    """
+    return torch.randn(batch_size*2, 4, int(height/8), int(width/8), device=device)[:batch_size]
+
+def createSampleFunction(
+        device,
+        model,
+        model_params, 
+        bert_model,
+        clip_model,
+        clip_preprocess,
+        ldm_model,
+        diffusion,
+        normalize,
+        image=None,
+        mask=None,
+        prompt="",
+        negative="",
+        guidance_scale=5.0,
+        batch_size=1,
+        width=256,
+        height=256,
+        cutn=16,
+        edit=None,
+        edit_width=None,
+        edit_height=None,
+        edit_x=0,
+        edit_y=0,
+        clip_guidance=False,
+        clip_guidance_scale=None,
+        skip_timesteps=False,
+        ddpm=False,
+        ddim=False,
+        dpm_solver=False,
+        fast_plms_warmup=False,
+        convergence_tolerance=0,
+        crop_margin=None,
+        embedding_cache=None,
+        latent_cache=None):
+    """
+    Creates a function that will generate a set of sample images, along with an accompanying clip ranking function.
+    If convergence_tolerance is greater than zero, sampling ends early once the inpainted area stops changing, see
+    stopWhenConverged. If crop_margin is set, only the inpainted area and crop_margin pixels around it are generated,
+    see cropToMask.
+    """
+    model_kwargs, text_emb_clip = createConditioning(
+            device,
+            model_params,
+            bert_model,
+            clip_model,
+            ldm_model,
+            mask=mask,
+            prompt=prompt,
+            negative=negative,
+            batch_size=batch_size,
+            width=width,
+            height=height,
+            edit=edit,
+            edit_width=edit_width,
+            edit_height=edit_height,
+            edit_x=edit_x,
+            edit_y=edit_y,
+            embedding_cache=embedding_cache,
+            latent_cache=latent_cache)
+    if clip_guidance and not clip_guidance_scale:
+        clip_guidance_scale = 150
+
+    make_cutouts = MakeCutouts(clip_model.visual.input_resolution, cutn)
+
+    text_emb_norm = text_emb_clip[0] / text_emb_clip[0].norm(dim=-1, keepdim=True)
+
+    model_fn = createGuidedModelFn(model, guidance_scale)
 
     def cond_fn(x, t, context=None, clip_embed=None, image_embed=None):
         with torch.enable_grad():
@@ -187,24 +367,131 @@ def createSampleFunction(
         base_sample_fn = diffusion.ddpm_sample_loop_progressive
     elif ddim:
         base_sample_fn = diffusion.ddim_sample_loop_progressive
+    elif dpm_solver:
+        base_sample_fn = diffusion.dpm_solver_sample_loop_progressive
     else:
-        base_sample_fn = diffusion.plms_sample_loop_progressive
+        base_sample_fn = partial(diffusion.plms_sample_loop_progressive, prk_warmup=not fast_plms_warmup)
+    sample_kwargs, crop_box = cropToMask(model, model_kwargs, batch_size, crop_margin)
     def sample_fn(init):
-        return base_sample_fn(
+        noise = cropLatent(createInitialNoise(batch_size, width, height, device), crop_box)
+        samples = base_sample_fn(
             model_fn,
-            (batch_size*2, 4, int(height/8), int(width/8)),
+            tuple(noise.shape),
+            noise=noise,
             clip_denoised=False,
-            model_kwargs=model_kwargs,
+            model_kwargs=sample_kwargs,
             cond_fn=cond_fn if clip_guidance else None,
             device=device,
             progress=True,
-            init_image=init,
+            init_image=cropLatent(init, crop_box),
             skip_timesteps=skip_timesteps
         )
+        if convergence_tolerance > 0:
+            samples = stopWhenConverged(samples, getInpaintingMask(sample_kwargs, batch_size), convergence_tolerance,
+                    diffusion.num_timesteps - skip_timesteps)
+        if crop_box is not None:
+            samples = pasteCroppedSamples(samples, model_kwargs["image_embed"][:batch_size], crop_box)
+        return samples
+    clip_size = clip_model.visual.input_resolution
     def clip_score_fn(image):
-        """Provides a CLIP score ranking image closeness to text"""
-        image_emb = clip_model.encode_image(clip_preprocess(image).unsqueeze(0).to(device))
+        """
+        Provides a CLIP score ranking image closeness to text. The image may be a PIL image, or a batch of image
+        tensors with values in [0, 1], which are scored together and preprocessed without leaving the device. A list
+        of scores is returned for image batches.
+        """
+        if isinstance(image, torch.Tensor):
+            clip_in = TF.resize(image, clip_size, interpolation=transforms.InterpolationMode.BICUBIC)
+            clip_in = normalize(TF.center_crop(clip_in, clip_size))
+        else:
+            clip_in = clip_preprocess(image).unsqueeze(0).to(device)
+        image_emb = clip_model.encode_image(clip_in)
         image_emb_norm = image_emb / image_emb.norm(dim=-1, keepdim=True)
         similarity = torch.nn.functional.cosine_similarity(image_emb_norm, text_emb_norm, dim=-1)
-        return similarity.item()
+        return similarity.tolist() if isinstance(image, torch.Tensor) else similarity.item()
     return sample_fn, clip_score_fn
+
+def createBatchedSampleFunction(
+        device,
+        model,
+        diffusion,
+        conditions,
+        width=256,
+        height=256,
+        skip_timesteps=False,
+        ddpm=False,
+        ddim=False,
+        dpm_solver=False,
+        fast_plms_warmup=False,
+        convergence_tolerance=0,
+        crop_margin=None):
+    """
+    Creates a function that generates samples for several independent requests within a single model batch. If
+    convergence_tolerance is greater than zero, sampling ends early once the inpainted areas of all requests stop
+    changing, see stopWhenConverged. If crop_margin is set, only the region containing every request's inpainted
+    area and crop_margin pixels around it is generated, see cropToMask.
+
+    Parameters:
+    -----------
+    conditions : list of (dict model_kwargs, int batch_size, float guidance_scale)
+        Per-request conditioning, with model_kwargs created by createConditioning. All requests must use the same
+        width, height, and skip_timesteps.
+
+    Merged model_kwargs hold the conditional entries of every request followed by the unconditional entries of every
+    request, in the same order. Use splitSample to extract each request's section of a generated sample.
+    """
+    batch_sizes = [batch_size for _, batch_size, _ in conditions]
+    total_size = sum(batch_sizes)
+
+    def mergeKwarg(key):
+        if conditions[0][0][key] is None:
+            return None
+        cond = [kwargs[key][:batch_size] for kwargs, batch_size, _ in conditions]
+        uncond = [kwargs[key][batch_size:] for kwargs, batch_size, _ in conditions]
+        return torch.cat(cond + uncond, dim=0)
+    model_kwargs = { key: mergeKwarg(key) for key in conditions[0][0] }
+
+    guidance_scale = torch.cat([torch.full((batch_size,), float(scale), device=device)
+            for _, batch_size, scale in conditions]).view(total_size, 1, 1, 1)
+    model_fn = createGuidedModelFn(model, guidance_scale)
+
+    if ddpm:
+        base_sample_fn = diffusion.ddpm_sample_loop_progressive
+    elif ddim:
+        base_sample_fn = diffusion.ddim_sample_loop_progressive
+    elif dpm_solver:
+        base_sample_fn = diffusion.dpm_solver_sample_loop_progressive
+    else:
+        base_sample_fn = partial(diffusion.plms_sample_loop_progressive, prk_warmup=not fast_plms_warmup)
+    sample_kwargs, crop_box = cropToMask(model, model_kwargs, total_size, crop_margin)
+    def sample_fn(init):
+        noise = cropLatent(createInitialNoise(total_size, width, height, device), crop_box)
+        samples = base_sample_fn(
+            model_fn,
+            tuple(noise.shape),
+            noise=noise,
+            clip_denoised=False,
+            model_kwargs=sample_kwargs,
+            device=device,
+            progress=True,
+            init_image=cropLatent(init, crop_box),
+            skip_timesteps=skip_timesteps
+        )
+        if convergence_tolerance > 0:
+            samples = stopWhenConverged(samples, getInpaintingMask(sample_kwargs, total_size), convergence_tolerance,
+                    diffusion.num_timesteps - skip_timesteps)
+        if crop_box is not None:
+            samples = pasteCroppedSamples(samples, model_kwargs["image_embed"][:total_size], crop_box)
+        return samples
+    return sample_fn
+
+def splitSample(sample, batch_sizes):
+    """
+    Splits a sample created by a function from createBatchedSampleFunction into one sample per merged request.
+    """
+    samples = []
+    offset = 0
+    for batch_size in batch_sizes:
+        samples.append({ key: value[offset:offset + batch_size] for key, value in sample.items()
+                if isinstance(value, torch.Tensor) })
+        offset += batch_size
+    return samples
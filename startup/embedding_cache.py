@@ -0,0 +1,97 @@
+# Caches text prompt embeddings and image latents, so repeated inputs don't need to be re-encoded
+import torch
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import os
+
+def getModelHash(*models):
+    """
+    Creates a hash string identifying a set of models, using the shapes of all parameters and the values of the
+    first and last parameters of each model. This is fast to compute, and changes whenever model weights change.
+    """
+    hasher = hashlib.sha256()
+    for model in models:
+        params = list(model.parameters())
+        for param in params:
+            hasher.update(str(tuple(param.shape)).encode('utf-8'))
+        for param in (params[0], params[-1]):
+            hasher.update(param.detach().float().cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+class EmbeddingCache():
+    """
+    Least-recently-used cache for encoded model inputs, such as prompt embeddings or image latents. Entries are keyed
+    by strings like a prompt or an image content hash. Entries evicted from memory are saved to cache_dir if it is
+    provided, and are loaded from there again when requested.
+    """
+
+    def __init__(self, model_hash, max_entries=256, cache_dir=None):
+        """
+        Parameters:
+        -----------
+        model_hash : str
+            Identifies the models used to create embeddings, see getModelHash.
+        max_entries : int
+            Maximum number of entries to keep in memory.
+        cache_dir : str (optional)
+            Directory where evicted entries are saved.
+        """
+        self.model_hash = model_hash
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _getPath(self, prompt):
+        key = hashlib.sha256(f'{self.model_hash}:{prompt}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, prompt, encode, device):
+        """
+        Returns cached embeddings for a prompt or other key string, calling encode(prompt) to create them if they
+        aren't cached. encode should return a tuple of tensors holding a single batch entry.
+        """
+        with self._lock:
+            if prompt in self._entries:
+                self._entries.move_to_end(prompt)
+                self.hits += 1
+                return self._entries[prompt]
+        embeddings = None
+        if self.cache_dir is not None and os.path.isfile(self._getPath(prompt)):
+            try:
+                embeddings = torch.load(self._getPath(prompt), map_location=device)
+            except Exception as err:
+                print(f'Failed to load cached embedding for "{prompt}": {err}')
+        with self._lock:
+            if embeddings is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if embeddings is None:
+            embeddings = tuple(embedding.detach() for embedding in encode(prompt))
+        self._add(prompt, embeddings)
+        return embeddings
+
+    def _add(self, prompt, embeddings):
+        evicted = []
+        with self._lock:
+            self._entries[prompt] = embeddings
+            self._entries.move_to_end(prompt)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        if self.cache_dir is None:
+            return
+        for evictedPrompt, evictedEmbeddings in evicted:
+            path = self._getPath(evictedPrompt)
+            if not os.path.isfile(path):
+                torch.save(tuple(embedding.cpu() for embedding in evictedEmbeddings), path)
+
+    def stats(self):
+        """Returns cache hit and miss counts, along with the number of entries held in memory."""
+        with self._lock:
+            return { "hits": self.hits, "misses": self.misses, "size": len(self._entries) }
@@ -1,6 +1,7 @@
 import torch
 from torchvision.transforms import functional as TF
 from PIL import Image
+from startup.create_sample_function import splitSample
 
 def generateSamples(
         device,
@@ -13,19 +14,68 @@ def generateSamples(
         width=256,
         height=256,
         init_image=None,
-        clip_score_fn=None):
-    """Given a sample generation function and a sample save function, start generating image samples."""
+        clip_score_fn=None,
+        should_stop=None,
+        preview_sample=None):
+    """
+    Given a sample generation function and a sample save function, start generating image samples.
+
+    If should_stop is provided, it is checked after every diffusion step, and generation ends early if it returns True.
+    If preview_sample is provided, it is used instead of save_sample for intermediate samples.
+    """
+    if preview_sample is None:
+        preview_sample = save_sample
     if init_image:
         init = Image.open(init_image).convert('RGB')
         init = init.resize((int(width),  int(height)), Image.LANCZOS)
         init = TF.to_tensor(init).to(device).unsqueeze(0).clamp(0,1)
         h = ldm_model.encode(init * 2 - 1).sample() *  0.18215
-        init = torch.cat(batch_size*2*[h], dim=0)
+        init = torch.cat(batch_size*[h], dim=0)
     else:
         init = None
     for i in range(num_batches):
         samples = sample_fn(init)
         for j, sample in enumerate(samples):
+            if should_stop is not None and should_stop():
+                return
             if j % 5 == 0 and j != diffusion.num_timesteps - 1:
-                save_sample(i, sample)
+                preview_sample(i, sample)
         save_sample(i, sample, clip_score_fn)
+
+def generateBatchedSamples(
+        diffusion,
+        sample_fn,
+        save_samples,
+        batch_sizes,
+        batch_index=0,
+        should_stop=None):
+    """
+    Generates one batch of samples for several merged requests, using a sample function created by
+    createBatchedSampleFunction.
+
+    Parameters:
+    -----------
+    save_samples : list of function(int i, dict sample, bool final)
+        Per-request sample save functions, each receiving only its own section of each sample. The final parameter
+        is True only for the fully denoised sample.
+    batch_sizes : list of int
+        Batch size of each merged request, in the same order used to create sample_fn.
+    batch_index : int
+        Batch number passed to save functions.
+    should_stop : function
+        Optional function checked after every diffusion step, generation ends early if it returns True.
+
+    Returns the number of diffusion steps used, which may be less than diffusion.num_timesteps if sample_fn stops
+    once samples converge. If should_stop ended generation, None is returned instead.
+    """
+    def saveAll(sample, final=False):
+        for save_sample, request_sample in zip(save_samples, splitSample(sample, batch_sizes)):
+            save_sample(batch_index, request_sample, final)
+    samples = sample_fn(None)
+    for j, sample in enumerate(samples):
+        if should_stop is not None and should_stop():
+            return None
+        if j % 5 == 0 and j != diffusion.num_timesteps - 1:
+            saveAll(sample)
+    saveAll(sample, True)
+    return j + 1
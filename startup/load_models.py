@@ -2,6 +2,9 @@ import torch
 from torchvision import transforms
 from guided_diffusion.script_util import create_model_and_diffusion, model_and_diffusion_defaults
 from encoders.modules import BERTEmbedder
+from startup.tiled_vae import TiledVAE
+from startup.compiled_models import SizeBucketedCompile, enableCompileCache, DEFAULT_COMPILE_SIZES
+from startup.embedding_cache import getModelHash
 import clip
 import gc
 
@@ -14,8 +17,21 @@ def loadModels( device,
         clip_guidance=False,
         cpu=False,
         ddpm=False,
-        ddim=False):
-    """Loads all ML models and associated variables."""
+        ddim=False,
+        attention_backend="einsum",
+        vae_tile_threshold=512 * 512,
+        compile_models=False,
+        compile_cache_dir=None,
+        compile_sizes=DEFAULT_COMPILE_SIZES):
+    """
+    Loads all ML models and associated variables. attention_backend selects how the diffusion model computes
+    attention, see UNetModel.set_attention_backend. Images with more pixels than vae_tile_threshold are encoded and
+    decoded in tiles to limit memory use, see TiledVAE.
+
+    If compile_models is True, the diffusion model and the VAE decoder are compiled with torch.compile for the
+    (width, height) image sizes in compile_sizes, other sizes run uncompiled. Compiled code is saved to
+    compile_cache_dir if provided.
+    """
     model_state_dict = torch.load(model_path, map_location='cpu')
 
     model_params = {
@@ -58,7 +74,16 @@ def loadModels( device,
     # Load models
     model, diffusion = create_model_and_diffusion(**model_config)
     model.load_state_dict(model_state_dict, strict=False)
+    model.set_attention_backend(attention_backend)
+    # Timesteps are fixed by the respaced schedule, so their embeddings can be computed once:
+    model.set_timestep_table(diffusion.reachable_timesteps())
     model.requires_grad_(clip_guidance).eval().to(device)
+    # Gradient checkpointing only matters when backpropagating through the model for CLIP guidance. The context
+    # cache changes module state within the UNet blocks, so it's left out when they're compiled:
+    if compile_models and not hasattr(torch, 'compile'):
+        print("Warning: model compilation requires torch 2.0 or newer, using uncompiled models.")
+        compile_models = False
+    model.set_inference_mode(not clip_guidance, cache_context=not compile_models)
 
     if model_config['use_fp16']:
         model.convert_to_fp16()
@@ -73,7 +98,7 @@ def loadModels( device,
     gc.collect()
 
     # vae
-    ldm = torch.load(kl_path, map_location="cpu")
+    ldm = TiledVAE(torch.load(kl_path, map_location="cpu"), tile_threshold=vae_tile_threshold)
     ldm.to(device)
     ldm.eval()
     ldm.requires_grad_(clip_guidance)
@@ -97,5 +122,13 @@ def loadModels( device,
     print(f"loaded and configured CLIP model from {clip_model_name}")
     gc.collect()
 
+    if compile_models:
+        if compile_cache_dir is not None:
+            enableCompileCache(compile_cache_dir, getModelHash(model, ldm))
+        # Only the block stack is compiled, embedding lookups and caches in forward stay uncompiled:
+        model.apply_blocks = SizeBucketedCompile(model.apply_blocks, compile_sizes, scale=8)
+        ldm.model.decode = SizeBucketedCompile(ldm.model.decode, compile_sizes, scale=8)
+        print(f"compiling diffusion model and VAE decoder for image sizes {compile_sizes}")
+
     normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073], std=[0.26862954, 0.26130258, 0.27577711])
     return model_params, model, diffusion, ldm, bert, clip_model, clip_preprocess, normalize
@@ -0,0 +1,111 @@
+# Splits large VAE encode/decode operations into overlapping tiles, so memory use doesn't grow with image size
+import torch
+
+# kl-f8 latents are 1/8th the resolution of the images they encode:
+LATENT_SCALE = 8
+
+def _tilePositions(size, tile, overlap):
+    """Returns tile start positions covering [0, size) with tiles of the given size that overlap by overlap."""
+    if size <= tile:
+        return [0]
+    positions = list(range(0, size - tile, tile - overlap))
+    positions.append(size - tile)
+    return positions
+
+def _blendWeights(size, overlap, device, dtype):
+    """
+    Returns 1D blending weights for one tile edge: weights ramp up over the overlap at each end so that overlapping
+    tiles fade into each other. Weights are never zero, so areas covered by a single tile are left unchanged.
+    """
+    idx = torch.arange(size, device=device, dtype=dtype)
+    ramp = torch.minimum(idx + 1, size - idx) / (overlap + 1)
+    return ramp.clamp(max=1)
+
+def tiledApply(tensor, fn, tile, overlap, scale):
+    """
+    Applies fn to overlapping tiles of a batched image tensor, blending tile outputs together.
+
+    Parameters:
+    -----------
+    tensor : Tensor
+        Input with shape (batch, channels, height, width).
+    fn : function
+        Maps an input tile to an output tile scale times its width and height.
+    tile : int
+        Input tile width and height.
+    overlap : int
+        Number of input pixels shared between adjacent tiles.
+    scale : float
+        Output to input size ratio, e.g. 8 when decoding latents or 1/8 when encoding images.
+    """
+    height, width = tensor.shape[-2:]
+    out = None
+    weights = None
+    for y in _tilePositions(height, tile, overlap):
+        for x in _tilePositions(width, tile, overlap):
+            tileOut = fn(tensor[:, :, y:y + tile, x:x + tile])
+            if out is None:
+                outShape = (tensor.shape[0], tileOut.shape[1], int(height * scale), int(width * scale))
+                out = torch.zeros(outShape, device=tileOut.device, dtype=tileOut.dtype)
+                weights = torch.zeros(outShape[-2:], device=tileOut.device, dtype=tileOut.dtype)
+            tileH, tileW = tileOut.shape[-2:]
+            outOverlap = int(overlap * scale)
+            weight = _blendWeights(tileH, outOverlap, out.device, out.dtype)[:, None] \
+                    * _blendWeights(tileW, outOverlap, out.device, out.dtype)[None, :]
+            outY = int(y * scale)
+            outX = int(x * scale)
+            out[:, :, outY:outY + tileH, outX:outX + tileW] += tileOut * weight
+            weights[outY:outY + tileH, outX:outX + tileW] += weight
+    return out / weights
+
+class TiledVAE(torch.nn.Module):
+    """
+    Wraps a kl-f8 autoencoder, encoding and decoding images larger than a pixel count threshold in overlapping tiles.
+    Tile outputs are blended across the overlap to hide seams, so peak memory depends on tile size instead of image
+    size. Smaller images are passed to the wrapped model unchanged.
+    """
+
+    def __init__(self, model, tile_threshold=512 * 512, tile_size=512, tile_overlap=64):
+        """
+        Parameters:
+        -----------
+        model : torch.nn.Module
+            The kl-f8 autoencoder to wrap.
+        tile_threshold : int
+            Images with more pixels than this are processed in tiles. Use 0 to always tile, or None to never tile.
+        tile_size : int
+            Tile width and height in image pixels, must be a multiple of 8.
+        tile_overlap : int
+            Pixels shared between adjacent tiles, must be a multiple of 8.
+        """
+        super().__init__()
+        assert tile_size % LATENT_SCALE == 0 and tile_overlap % LATENT_SCALE == 0
+        assert tile_overlap < tile_size
+        self.model = model
+        self.tile_threshold = tile_threshold
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+
+    def _shouldTile(self, pixelCount):
+        return self.tile_threshold is not None and pixelCount > self.tile_threshold
+
+    def encode(self, images):
+        """Encodes images with values in [-1, 1], returning the wrapped model's posterior distribution type."""
+        if not self._shouldTile(images.shape[-2] * images.shape[-1]):
+            return self.model.encode(images)
+        posteriorType = None
+        def encodeTile(tile):
+            nonlocal posteriorType
+            posterior = self.model.encode(tile)
+            posteriorType = type(posterior)
+            return posterior.parameters
+        parameters = tiledApply(images, encodeTile, self.tile_size, self.tile_overlap, 1 / LATENT_SCALE)
+        return posteriorType(parameters)
+
+    def decode(self, latents):
+        """Decodes unscaled latents to images with values in [-1, 1]."""
+        pixelCount = latents.shape[-2] * latents.shape[-1] * LATENT_SCALE * LATENT_SCALE
+        if not self._shouldTile(pixelCount):
+            return self.model.decode(latents)
+        return tiledApply(latents, self.model.decode, self.tile_size // LATENT_SCALE,
+                self.tile_overlap // LATENT_SCALE, LATENT_SCALE)
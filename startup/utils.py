@@ -16,15 +16,38 @@ def fetch(url_or_path):
         return fd
     return open(url_or_path, 'rb')
 
-def imageToBase64(pilImage):
-    """Convert a PIL image to a base64 string."""
+def imageToBytes(pilImage, format='PNG', quality=None):
+    """
+    Encode a PIL image using an image file format. Quality is only used by lossy formats (WEBP, JPEG), while RAW
+    returns unencoded pixel data.
+    """
+    if format == 'RAW':
+        return pilImage.tobytes()
     buffer = io.BytesIO()
-    pilImage.save(buffer, format='PNG')
-    return str(base64.b64encode(buffer.getvalue()), 'utf-8')
+    if format in ('WEBP', 'JPEG'):
+        if pilImage.mode not in ('RGB', 'L'):
+            pilImage = pilImage.convert('RGB')
+        pilImage.save(buffer, format=format, quality=quality if quality is not None else 80)
+    else:
+        pilImage.save(buffer, format=format)
+    return buffer.getvalue()
+
+def imageToBase64(pilImage, format='PNG', quality=None):
+    """Convert a PIL image to a base64 string."""
+    return str(base64.b64encode(imageToBytes(pilImage, format, quality)), 'utf-8')
+
+def loadImageFromBytes(imageBytes, rawMode=None, rawSize=None):
+    """
+    Initialize a PIL image object from encoded image file data, or from unencoded pixel data if rawMode and rawSize
+    are provided.
+    """
+    if rawMode is not None:
+        return Image.frombytes(rawMode, rawSize, imageBytes)
+    return Image.open(io.BytesIO(imageBytes))
 
 def loadImageFromBase64(imageStr):
     """Initialize a PIL image object from base64-encoded string data."""
-    return Image.open(io.BytesIO(base64.b64decode(imageStr)))
+    return loadImageFromBytes(base64.b64decode(imageStr))
 
 def buildArgParser(defaultModel='inpaint.pt', includeEditParams=True, includeGenParams=True):
     """Create a command-line argument parser that includes options shared between several scripts"""
@@ -101,4 +124,25 @@ def buildArgParser(defaultModel='inpaint.pt', includeEditParams=True, includeGen
     parser.add_argument('--ddim', dest='ddim', action='store_true') # turn on to use 50 step ddim
 
     parser.add_argument('--ddpm', dest='ddpm', action='store_true') # turn on to use 50 step ddim
+
+    parser.add_argument('--dpm_solver', dest='dpm_solver', action='store_true',
+                        help='use the DPM-Solver++ sampler, which needs fewer steps (try --steps 15)')
+
+    parser.add_argument('--fast_plms_warmup', dest='fast_plms_warmup', action='store_true',
+                        help='start PLMS sampling with lower-order multistep updates instead of PRK, saving 9 model evaluations')
+
+    parser.add_argument('--convergence_tolerance', type = float, default = 0, required = False,
+                        help='if greater than zero, stop sampling early once the inpainted area changes less than this between steps (try 0.002)')
+
+    parser.add_argument('--crop_margin', type = int, default = None, required = False,
+                        help='if set, only generate the masked area plus this many pixels of surrounding context (try 64)')
+
+    parser.add_argument('--compile', dest='compile', action='store_true',
+                        help='compile the diffusion model and VAE decoder for common image sizes (requires torch 2.0+)')
+    parser.add_argument('--compile_cache_dir', type = str, default = 'compile_cache', required = False,
+                        help='directory used to save compiled models between runs')
+
+    parser.add_argument('--attention_backend', type = str, default = 'einsum', required = False,
+                        choices = ['einsum', 'sdpa', 'chunked'],
+                        help='how attention is computed: einsum (default), sdpa (fused, needs torch 2.0+), or chunked (lower memory use)')
     return parser
@@ -0,0 +1,64 @@
+# Checks that all attention backends in guided_diffusion.unet produce the same results
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+from guided_diffusion.unet import ATTENTION_BACKENDS, CrossAttention, QKVAttention, attention
+
+# Smaller than every sequence length used below, so chunked attention always runs more than one chunk:
+CHUNK_SIZE = 7
+
+def _backends():
+    backends = list(ATTENTION_BACKENDS)
+    if not hasattr(th.nn.functional, "scaled_dot_product_attention"):
+        backends.remove("sdpa")
+    return backends
+
+def _randomMask(shape):
+    mask = th.rand(shape) > 0.5
+    # Rows without any allowed positions are undefined in sdpa, so always allow the first one:
+    mask[..., 0] = True
+    return mask
+
+@pytest.mark.parametrize("backend", _backends())
+@pytest.mark.parametrize("useMask", [False, True])
+@pytest.mark.parametrize("useContext", [False, True])
+def test_cross_attention_backends_match(backend, useMask, useContext):
+    th.manual_seed(0)
+    module = CrossAttention(16, context_dim=12 if useContext else None, heads=2, dim_head=8).eval()
+    x = th.randn(2, 20, 16)
+    context = th.randn(2, 9, 12) if useContext else None
+    mask = _randomMask((2, 9 if useContext else 20)) if useMask else None
+    with th.no_grad():
+        expected = module(x, context=context, mask=mask)
+        module.attention_backend = backend
+        module.attention_chunk_size = CHUNK_SIZE
+        actual = module(x, context=context, mask=mask)
+    assert th.allclose(actual, expected, atol=1e-5)
+
+@pytest.mark.parametrize("backend", _backends())
+def test_qkv_attention_backends_match(backend):
+    th.manual_seed(0)
+    module = QKVAttention(2)
+    qkv = th.randn(3, 3 * 2 * 8, 20)
+    with th.no_grad():
+        expected = module(qkv)
+        module.attention_backend = backend
+        module.attention_chunk_size = CHUNK_SIZE
+        actual = module(qkv)
+    assert th.allclose(actual, expected, atol=1e-5)
+
+@pytest.mark.parametrize("backend", [backend for backend in _backends() if backend != "einsum"])
+def test_attention_with_per_query_mask(backend):
+    th.manual_seed(0)
+    q = th.randn(4, 20, 8)
+    k = th.randn(4, 11, 8)
+    v = th.randn(4, 11, 8)
+    # A full [B x T x S] mask, so chunked attention has to slice the mask along with the queries:
+    mask = _randomMask((4, 20, 11))
+    sim = th.einsum('b i d, b j d -> b i j', q, k) * 8 ** -0.5
+    sim.masked_fill_(~mask, -th.finfo(sim.dtype).max)
+    expected = th.einsum('b i j, b j d -> b i d', sim.softmax(dim=-1), v)
+    actual = attention(q, k, v, backend, mask=mask, chunk_size=CHUNK_SIZE)
+    assert th.allclose(actual, expected, atol=1e-5)
@@ -0,0 +1,53 @@
+# Checks that size-bucketed compilation of the UNet blocks doesn't recompile for new batch sizes
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("einops")
+if not hasattr(th, "compile"):
+    pytest.skip("torch.compile requires torch 2.0 or newer", allow_module_level=True)
+
+from torch._dynamo.utils import counters
+from guided_diffusion.unet import UNetModel
+from startup.compiled_models import SizeBucketedCompile
+
+def test_compiled_blocks_match_for_all_batch_sizes():
+    th.manual_seed(0)
+    model = UNetModel(
+            image_size=8,
+            in_channels=4,
+            model_channels=32,
+            out_channels=4,
+            num_res_blocks=1,
+            attention_resolutions=(2,),
+            channel_mult=(1, 2),
+            num_heads=2,
+            context_dim=16,
+            clip_embed_dim=12).eval()
+    with th.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.2)
+    model.set_timestep_table(list(range(1000)))
+    model.set_inference_mode(True, cache_context=False)
+    sizes = [(64, 64), (64, 128)]
+    blocks = model.apply_blocks
+    compiled = SizeBucketedCompile(blocks, sizes, scale=8, backend="eager")
+
+    th._dynamo.reset()
+    counters.clear()
+    for width, height in sizes:
+        for batch_size in range(1, 5):
+            kwargs = {
+                "context": th.randn(batch_size, 5, 16),
+                "clip_embed": th.randn(batch_size, 12)
+            }
+            x = th.randn(batch_size, 4, height // 8, width // 8)
+            timesteps = th.randint(0, 1000, (batch_size,))
+            with th.no_grad():
+                model.apply_blocks = blocks
+                expected = model(x, timesteps, **kwargs)
+                model.apply_blocks = compiled
+                actual = model(x, timesteps, **kwargs)
+            assert th.allclose(actual, expected, atol=1e-4)
+    # One graph per image size for batch size 1, and one for all larger batch sizes:
+    assert counters["stats"]["unique_graphs"] <= 2 * len(sizes)
+    assert len(counters["graph_break"]) == 0
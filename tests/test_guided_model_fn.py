@@ -0,0 +1,50 @@
+# Checks that classifier-free guidance over only the conditional half of the batch gives the same images as the
+# original full-width guidance function
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("clip")
+
+from guided_diffusion.script_util import create_gaussian_diffusion
+from startup.create_sample_function import createGuidedModelFn, createInitialNoise
+
+BATCH_SIZE = 2
+GUIDANCE_SCALE = 5.0
+
+def _stubModel(x, ts, context=None):
+    """Stand-in for the UNet, with output that depends on x, ts and the conditioning."""
+    scale = 1 + context.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+    return torch.tanh(x * scale + ts.float().view(-1, 1, 1, 1) / 1000) * 0.5
+
+def _fullWidthModelFn(x_t, ts, **kwargs):
+    """The original guidance function, which kept both halves of the batch in the sampler."""
+    half = x_t[: len(x_t) // 2]
+    combined = torch.cat([half, half], dim=0)
+    model_out = _stubModel(combined, ts, **kwargs)
+    eps, rest = model_out[:, :3], model_out[:, 3:]
+    cond_eps, uncond_eps = torch.split(eps, len(eps) // 2, dim=0)
+    half_eps = uncond_eps + GUIDANCE_SCALE * (cond_eps - uncond_eps)
+    eps = torch.cat([half_eps, half_eps], dim=0)
+    return torch.cat([eps, rest], dim=1)
+
+def _finalSample(sample_loop, model_fn, noise, **kwargs):
+    # Conditional entries first, then unconditional entries, as created by createConditioning:
+    model_kwargs = {"context": torch.randn(BATCH_SIZE * 2, 5, 16, generator=torch.Generator().manual_seed(1))}
+    final = None
+    for sample in sample_loop(model_fn, tuple(noise.shape), noise=noise, clip_denoised=False,
+            model_kwargs=model_kwargs, device="cpu", **kwargs):
+        final = sample
+    return final["pred_xstart"]
+
+@pytest.mark.parametrize("sampler", ["plms", "ddim"])
+def test_half_width_guidance_matches_full_width(sampler):
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing="10")
+    sample_loop = getattr(diffusion, sampler + "_sample_loop_progressive")
+    torch.manual_seed(0)
+    fullNoise = torch.randn(BATCH_SIZE * 2, 4, 4, 4)
+    expected = _finalSample(sample_loop, _fullWidthModelFn, fullNoise)[:BATCH_SIZE]
+    torch.manual_seed(0)
+    noise = createInitialNoise(BATCH_SIZE, 32, 32, "cpu")
+    actual = _finalSample(sample_loop, createGuidedModelFn(_stubModel, GUIDANCE_SCALE), noise)
+    assert actual.shape == expected.shape
+    assert torch.equal(actual, expected)
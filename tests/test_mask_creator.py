@@ -0,0 +1,49 @@
+# Checks that MaskCreator's stored strokes rasterize in the right place
+import os
+import pytest
+
+pytest.importorskip("PyQt5")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PIL import Image
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QPointF, QSize, Qt
+from edit_ui.mask_creator import MaskCreator, _Stroke
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+def _addLine(maskCreator, start, end):
+    stroke = _Stroke(False, QSize(maskCreator.selectionWidth(), maskCreator.selectionHeight()), 4, Qt.red)
+    stroke.points.append(QPointF(*start))
+    stroke.points.append(QPointF(*end))
+    maskCreator._addStroke(stroke)
+
+def _alpha(mask, x, y):
+    return mask.getpixel((x, y))[3]
+
+def test_resize_stretches_flattened_and_live_strokes(app):
+    maskCreator = MaskCreator(Image.new("RGB", (64, 64)), maxUndoStrokes=1)
+    _addLine(maskCreator, (8, 16), (24, 16))
+    _addLine(maskCreator, (40, 48), (56, 48))
+    # Only the second line can still be undone, the first was flattened into the base layer:
+    assert len(maskCreator._strokes) == 1
+    assert False in maskCreator._baseLayers
+
+    maskCreator.setSelectionSize(QSize(128, 64))
+    mask = maskCreator.getMask()
+    assert mask.size == (128, 64)
+    for x in (16, 32, 48):
+        assert _alpha(mask, x, 16) > 0
+    for x in (80, 96, 112):
+        assert _alpha(mask, x, 48) > 0
+    # Where the lines would be if either kept its original position:
+    assert _alpha(mask, 60, 16) == 0
+    assert _alpha(mask, 48, 48) == 0
+
+    # Strokes drawn after resizing use the new selection coordinates:
+    _addLine(maskCreator, (8, 32), (120, 32))
+    mask = maskCreator.getMask()
+    for x in (8, 64, 120):
+        assert _alpha(mask, x, 32) > 0
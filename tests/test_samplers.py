@@ -0,0 +1,105 @@
+# Checks the diffusion samplers against each other, using a stand-in model that denoises Gaussian data exactly
+import pytest
+
+th = pytest.importorskip("torch")
+
+from guided_diffusion.script_util import create_gaussian_diffusion
+
+# Standard deviation of the stand-in model's data distribution:
+DATA_STD = 0.5
+SHAPE = (2, 4, 8, 8)
+
+_ALPHAS_CUMPROD = th.from_numpy(create_gaussian_diffusion(steps=1000).alphas_cumprod)
+
+def _gaussianDataModel(x, ts, **kwargs):
+    """
+    Returns the exact eps prediction for data drawn from N(0, DATA_STD^2), for original process timesteps, which may
+    fall between integers for PRK half-steps.
+    """
+    ts = ts.double()
+    alpha_bar = th.lerp(_ALPHAS_CUMPROD[ts.floor().long()], _ALPHAS_CUMPROD[ts.ceil().long()], ts.frac())
+    alpha_bar = alpha_bar.view(-1, 1, 1, 1)
+    eps = th.sqrt(1 - alpha_bar) * x.double() / (alpha_bar * DATA_STD ** 2 + 1 - alpha_bar)
+    return eps.to(x.dtype)
+
+def _noise():
+    return th.randn(*SHAPE, generator=th.Generator().manual_seed(0))
+
+def _sample(method, steps, **kwargs):
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(steps))
+    sample_loop = getattr(diffusion, method)
+    return sample_loop(_gaussianDataModel, SHAPE, noise=_noise(), clip_denoised=False, device="cpu", **kwargs)
+
+def _exactSample():
+    """
+    Returns the sample that the probability flow ODE maps the initial noise to, which every deterministic sampler
+    should approach as the number of steps increases. For Gaussian data this just rescales the noise.
+    """
+    alpha_bar = _ALPHAS_CUMPROD[-1]
+    return (_noise().double() * DATA_STD / th.sqrt(alpha_bar * DATA_STD ** 2 + 1 - alpha_bar)).float()
+
+def _error(sample):
+    return (sample - _exactSample()).abs().max().item()
+
+def test_dpm_solver_converges_faster_than_ddim():
+    steps = [25, 50, 100, 250]
+    dpmErrors = [_error(_sample("dpm_solver_sample_loop", count)) for count in steps]
+    ddimErrors = [_error(_sample("ddim_sample_loop", count)) for count in steps]
+    assert all(dpmErrors[i] > dpmErrors[i + 1] for i in range(len(steps) - 1))
+    # 250 DDIM steps are the reference quality, DPM-Solver++ should match it well before that:
+    assert ddimErrors[-1] < 0.05
+    assert dpmErrors[2] < ddimErrors[-1] * 2
+    assert dpmErrors[-1] < ddimErrors[-1] / 4
+    # Second-order convergence, compared to first-order for DDIM:
+    assert dpmErrors[-1] < dpmErrors[2] / 4
+    assert all(dpm < ddim for dpm, ddim in zip(dpmErrors[1:], ddimErrors[1:]))
+
+def _baselinePlmsTrajectory(diffusion, noise):
+    """Runs PLMS the way it was always done before lower-order warm-up: three PRK steps, then fourth-order PLMS."""
+    img = noise
+    old_eps = []
+    trajectory = []
+    for i in reversed(range(diffusion.num_timesteps)):
+        t = th.tensor([i] * len(img))
+        if len(old_eps) < 3:
+            out = diffusion.prk_sample(_gaussianDataModel, img, t, clip_denoised=False)
+        else:
+            eps = diffusion.get_eps(_gaussianDataModel, img, t, {})
+            eps_prime = (55 * eps - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+            out = {
+                "sample": diffusion.pndm_transfer(img, eps_prime, t, t - 1),
+                "pred_xstart": diffusion.eps_to_pred_xstart(img, eps, t),
+                "eps": eps
+            }
+            old_eps.pop(0)
+        old_eps.append(out["eps"])
+        trajectory.append(out)
+        img = out["sample"]
+    return trajectory
+
+def _plmsTrajectory(steps, prk_warmup, model=_gaussianDataModel):
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing=str(steps))
+    return list(diffusion.plms_sample_loop_progressive(model, SHAPE, noise=_noise(), clip_denoised=False,
+            device="cpu", prk_warmup=prk_warmup))
+
+def test_plms_with_prk_warmup_matches_baseline():
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing="25")
+    expected = _baselinePlmsTrajectory(diffusion, _noise())
+    actual = _plmsTrajectory(25, True)
+    assert len(actual) == len(expected)
+    for actualStep, expectedStep in zip(actual, expected):
+        for key in ("sample", "pred_xstart", "eps"):
+            assert th.equal(actualStep[key], expectedStep[key])
+
+def test_plms_lower_order_warmup_quality():
+    calls = []
+    def countingModel(x, ts, **kwargs):
+        calls.append(ts)
+        return _gaussianDataModel(x, ts, **kwargs)
+    prkError = _error(_plmsTrajectory(25, True, countingModel)[-1]["pred_xstart"])
+    prkCalls = len(calls)
+    calls.clear()
+    fastError = _error(_plmsTrajectory(25, False, countingModel)[-1]["pred_xstart"])
+    # Three PRK steps take four model evaluations each, lower-order steps take one:
+    assert prkCalls - len(calls) == 9
+    assert fastError < prkError * 1.1
@@ -0,0 +1,58 @@
+# Checks that tiled VAE processing matches untiled processing, using small stand-in functions instead of the VAE
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from startup.tiled_vae import _tilePositions, tiledApply
+
+# (height, width) pairs that don't divide evenly into tiles, so the last tile in each direction starts at size - tile:
+SIZES = [(24, 56), (56, 24), (40, 72)]
+
+def _exactPositions(size, tile, overlap, reach):
+    """
+    Returns a boolean mask of positions along one axis where a function that reads reach positions around each
+    input position gives the same result tiled and untiled: every tile covering the position must have it at least
+    reach positions away from any tile edge that isn't also an image edge.
+    """
+    exact = torch.ones(size, dtype=torch.bool)
+    for start in _tilePositions(size, tile, overlap):
+        end = min(start + tile, size)
+        for position in range(start, end):
+            nearStart = start > 0 and position - start < reach
+            nearEnd = end < size and end - 1 - position < reach
+            if nearStart or nearEnd:
+                exact[position] = False
+    return exact
+
+@pytest.mark.parametrize("height,width", SIZES)
+def test_tiled_decode_matches_untiled(height, width):
+    torch.manual_seed(0)
+    latents = torch.randn(2, 4, height, width)
+    decode = lambda tile: F.interpolate(tile, scale_factor=8, mode='nearest')
+    tiled = tiledApply(latents, decode, 16, 4, 8)
+    assert not torch.isnan(tiled).any()
+    assert torch.allclose(tiled, decode(latents), atol=1e-5)
+
+@pytest.mark.parametrize("height,width", SIZES)
+def test_tiled_encode_matches_untiled(height, width):
+    torch.manual_seed(0)
+    images = torch.randn(1, 3, height * 8, width * 8)
+    encode = lambda tile: F.avg_pool2d(tile, 8)
+    tiled = tiledApply(images, encode, 128, 32, 1 / 8)
+    assert not torch.isnan(tiled).any()
+    assert torch.allclose(tiled, encode(images), atol=1e-5)
+
+@pytest.mark.parametrize("height,width", SIZES)
+def test_tiled_conv_matches_untiled_away_from_tile_edges(height, width):
+    torch.manual_seed(0)
+    conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+    latents = torch.randn(1, 4, height, width)
+    tile, overlap = 16, 6
+    with torch.no_grad():
+        tiled = tiledApply(latents, conv, tile, overlap, 1)
+        untiled = conv(latents)
+    assert not torch.isnan(tiled).any()
+    exact = _exactPositions(height, tile, overlap, 1)[:, None] & _exactPositions(width, tile, overlap, 1)[None, :]
+    assert exact.any()
+    assert torch.allclose(tiled[..., exact], untiled[..., exact], atol=1e-5)
@@ -0,0 +1,98 @@
+# Checks that UNetModel's inference mode caches don't change model outputs
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+from guided_diffusion.unet import CrossAttention, UNetModel
+
+def _tinyModel():
+    th.manual_seed(0)
+    model = UNetModel(
+            image_size=8,
+            in_channels=4,
+            model_channels=32,
+            out_channels=4,
+            num_res_blocks=1,
+            attention_resolutions=(1, 2),
+            channel_mult=(1, 2),
+            num_heads=2,
+            context_dim=16,
+            clip_embed_dim=12).eval()
+    # Output layers start zeroed, which would hide differences in the layers before them:
+    with th.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.2)
+    return model
+
+def _inputs(seed):
+    generator = th.Generator().manual_seed(seed)
+    return {
+        "context": th.randn(2, 5, 16, generator=generator),
+        "clip_embed": th.randn(2, 12, generator=generator)
+    }
+
+def _run(model, x, timesteps, conditioning):
+    with th.no_grad():
+        return model(x, timesteps, **conditioning)
+
+def test_inference_mode_caches_match_uncached_outputs():
+    model = _tinyModel()
+    x = th.randn(2, 4, 8, 8)
+    timesteps = th.tensor([10, 500])
+    first = _inputs(1)
+    second = _inputs(2)
+    expectedFirst = _run(model, x, timesteps, first)
+    expectedSecond = _run(model, x, timesteps, second)
+    assert not th.allclose(expectedFirst, expectedSecond)
+
+    model.set_inference_mode(True)
+    # Repeated calls with the same conditioning tensors use cached values:
+    for _ in range(2):
+        assert th.allclose(_run(model, x, timesteps, first), expectedFirst, atol=1e-5)
+    assert model._clip_proj_cache is not None
+    assert any(module._context_cache is not None for module in model.modules() if isinstance(module, CrossAttention))
+    # Different conditioning tensors must replace cached values, and switching back must not reuse them:
+    assert th.allclose(_run(model, x, timesteps, second), expectedSecond, atol=1e-5)
+    assert th.allclose(_run(model, x, timesteps, first), expectedFirst, atol=1e-5)
+
+    model.set_inference_mode(False)
+    assert th.allclose(_run(model, x, timesteps, second), expectedSecond, atol=1e-5)
+
+def test_inference_mode_caches_detect_in_place_changes():
+    model = _tinyModel()
+    x = th.randn(2, 4, 8, 8)
+    timesteps = th.tensor([10, 500])
+    second = _inputs(2)
+    expected = _run(model, x, timesteps, second)
+
+    model.set_inference_mode(True)
+    conditioning = _inputs(1)
+    _run(model, x, timesteps, conditioning)
+    # Same tensor objects as the cached ones, but with new values:
+    conditioning["context"].copy_(second["context"])
+    conditioning["clip_embed"].copy_(second["clip_embed"])
+    assert th.allclose(_run(model, x, timesteps, conditioning), expected, atol=1e-5)
+
+def test_timestep_table_matches_computed_embeddings():
+    from guided_diffusion.script_util import create_gaussian_diffusion
+    model = _tinyModel()
+    diffusion = create_gaussian_diffusion(steps=1000, timestep_respacing="25")
+    # Sampler timesteps are spaced indices, or halfway between them for PRK steps:
+    indices = th.arange(0, diffusion.num_timesteps * 2 - 1).float() / 2
+    timesteps = diffusion._wrap_model(lambda x, ts: ts)(None, indices)
+    with th.no_grad():
+        expected = model._embed_timesteps(timesteps)
+        model.set_timestep_table(diffusion.reachable_timesteps())
+        assert th.allclose(model._embed_timesteps(timesteps), expected, atol=1e-5)
+        model.set_inference_mode(True)
+        assert th.allclose(model._embed_timesteps(timesteps), expected, atol=1e-5)
+
+def test_timesteps_missing_from_table_are_computed():
+    model = _tinyModel()
+    timesteps = th.tensor([0.0, 10.0, 15.5, 20.0, 999.0])
+    with th.no_grad():
+        expected = model._embed_timesteps(timesteps)
+        model.set_timestep_table([0, 10, 20])
+        actual = model._embed_timesteps(timesteps)
+    assert th.allclose(actual, expected, atol=1e-5)
@@ -0,0 +1,54 @@
+# Checks that UNetModel's inference mode skips gradient checkpointing without changing model outputs
+import pytest
+
+th = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+import guided_diffusion.unet as unet
+from guided_diffusion.unet import UNetModel
+
+def _tinyModel():
+    th.manual_seed(0)
+    model = UNetModel(
+            image_size=8,
+            in_channels=4,
+            model_channels=32,
+            out_channels=4,
+            num_res_blocks=1,
+            attention_resolutions=(1, 2),
+            channel_mult=(1, 2),
+            num_heads=2,
+            use_checkpoint=True,
+            context_dim=16,
+            clip_embed_dim=12).eval()
+    # Output layers start zeroed, which would hide differences in the layers before them:
+    with th.no_grad():
+        for param in model.parameters():
+            param.normal_(0, 0.2)
+    return model
+
+def test_inference_mode_skips_checkpointing(monkeypatch):
+    model = _tinyModel()
+    checkpointFlags = []
+    def countingCheckpoint(func, inputs, params, flag):
+        checkpointFlags.append(flag)
+        return checkpoint(func, inputs, params, flag)
+    checkpoint = unet.checkpoint
+    monkeypatch.setattr(unet, "checkpoint", countingCheckpoint)
+
+    x = th.randn(2, 4, 8, 8)
+    timesteps = th.tensor([10, 500])
+    kwargs = { "context": th.randn(2, 5, 16), "clip_embed": th.randn(2, 12) }
+    with th.no_grad():
+        expected = model(x, timesteps, **kwargs)
+        assert any(checkpointFlags)
+
+        checkpointFlags.clear()
+        model.set_inference_mode(True)
+        actual = model(x, timesteps, **kwargs)
+        assert len(checkpointFlags) == 0
+        assert th.allclose(actual, expected, atol=1e-5)
+
+        model.set_inference_mode(False)
+        model(x, timesteps, **kwargs)
+        assert any(checkpointFlags)